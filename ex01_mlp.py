@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-import json
+from tweets_loader import load_tweets, cached_frames, TWEET_INDEX
 from sklearn.feature_extraction.text import TfidfTransformer
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.pipeline import Pipeline
@@ -16,10 +16,8 @@ from sklearn.model_selection import cross_val_score
 
 # creates a data frame from a json file
 def create_tweets_df(file_name):
-    tweets = []
-    for line in open(file_name, 'r',encoding='utf-8-sig'):
-        tweets.append(json.loads(line))
-    return pd.DataFrame(tweets, columns=['tweetIDs','text'])
+    # only tweetIDs (int64) and text are read, see tweets_loader
+    return load_tweets(file_name)
 
 # creates a data frame from a csv file
 def create_df_from_csv(file_name, column_names):
@@ -27,22 +25,26 @@ def create_df_from_csv(file_name, column_names):
     return csvDf
 
 # merges two data frames
-def merge_tweets_and_labels(tweets, labels):
-    # merge tweets_id and train/test labels data set to get the training and test data
-    merged_df = pd.merge(left = tweets, right=labels,left_on ='tweetIDs',right_on='tweetIDs', how='inner')
+def merge_tweets_and_labels(tweets_index, labels):
+    # merge tweets_id and train/test labels data set to get the training and test data,
+    # same result as pd.merge on tweetIDs without hashing the tweets for every label file
+    merged_df = tweets_index.join(labels)
     return merged_df
 
 def data_preprocessing():
+    # merged data sets are cached until one of the data files changes
+    return cached_frames(['tweets.json', 'labels-train+dev.tsv', 'labels-test.tsv'], merge_data_sets)
+
+def merge_data_sets():
     # Data Preprocessing
     tweets_df = create_tweets_df('tweets.json')
     train_labels = create_df_from_csv('labels-train+dev.tsv', ['label','tweetIDs'])
     test_labels = create_df_from_csv('labels-test.tsv',['label', 'tweetIDs'])
 
-    # adjust data type of tweetIDs to match the labels
-    tweets_df['tweetIDs']=tweets_df['tweetIDs'].astype('int64')
     # merge tweets and labels to get the training df
-    train = merge_tweets_and_labels(tweets_df, train_labels)
-    test = merge_tweets_and_labels(tweets_df, test_labels)
+    tweets_index = TWEET_INDEX(tweets_df)
+    train = merge_tweets_and_labels(tweets_index, train_labels)
+    test = merge_tweets_and_labels(tweets_index, test_labels)
     return train,test
 
 def data_cleaning(train,test):
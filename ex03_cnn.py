@@ -4,7 +4,7 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import json
+from tweets_loader import load_tweets, cached_frames, TWEET_INDEX
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 
@@ -93,11 +93,8 @@ class DATA_PREPROCESSOR():
         filename = self.file_name1
         print(filename)
 
-        tweets = []
-        for line in open(filename, 'r',encoding='utf-8-sig'):
-             tweets.append(json.loads(line))
-
-        tweets_df = pd.DataFrame(tweets, columns=['tweetIDs','text'])
+        # only tweetIDs (int64) and text are read, see tweets_loader
+        tweets_df = load_tweets(filename)
 
         filename = self.file_name2
 
@@ -108,11 +105,12 @@ class DATA_PREPROCESSOR():
 
         return(tweets_df,train_labels, test_labels)
 
-    def merge_tweets_and_labels(self,tweets, labels):
+    def merge_tweets_and_labels(self,tweets_index, labels):
         """
-        merge tweets_id and train/test labels data set to get the training and test data
+        merge tweets_id and train/test labels data set to get the training and test data,
+        tweets_index is a TWEET_INDEX built once for both label files
         """
-        merged_df = pd.merge(left = tweets, right=labels,left_on ='tweetIDs',right_on='tweetIDs', how='inner')
+        merged_df = tweets_index.join(labels)
         return merged_df
 
     def handle_class_imblance(self,train):
@@ -179,17 +177,24 @@ class DATA_PREPROCESSOR():
         y_validation = to_categorical(y_validation,num_class)
         return (x_train, x_test, x_validation, y_train, y_test,y_validation)
 
+    def merge_data_sets(self):
+        '''
+        Read the data files and merge tweets and labels into the train and test set
+        '''
+        tweets_df,train_labels, test_labels = self.readDataSet()
+        # merge tweets and labels to get the training df
+        tweets_index = TWEET_INDEX(tweets_df)
+        train = self.merge_tweets_and_labels(tweets_index, train_labels)
+        test = self.merge_tweets_and_labels(tweets_index, test_labels)
+        return train, test
+
     def preprocess_data(self):
         '''
         Preprocess the input corpus. Following steps are involed in data cleaning
 
         '''
-        tweets_df,train_labels, test_labels = self.readDataSet()
-         # adjust data type of tweetIDs to match the labels
-        tweets_df['tweetIDs']=tweets_df['tweetIDs'].astype('int64')
-        # merge tweets and labels to get the training df
-        train = self.merge_tweets_and_labels(tweets_df, train_labels)
-        test = self.merge_tweets_and_labels(tweets_df, test_labels)
+        # merged data sets are cached until one of the data files changes
+        train, test = cached_frames([self.file_name1, self.file_name2, self.file_name3], self.merge_data_sets)
         train, validation, test = self.data_cleaning(train, test)
 
         return train, validation, test
@@ -0,0 +1,212 @@
+"""
+Batched inference with a trained CBOW model: predict the center word of many contexts at once.
+
+Usage:
+    python cbow_inference.py checkpoint.pth --contexts contexts.txt --topk 5
+    python cbow_inference.py checkpoint.pth --benchmark
+    python cbow_inference.py checkpoint.pth --torchscript cbow-topk.pt
+
+The checkpoint is loaded once, the output layer and context size are read from the
+shapes of its weights. A contexts file has one context per line, the 2*context_size
+words around the missing center word separated by spaces.
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from ex02_wordembeddings import CBOW, load_checkpoint
+
+BENCHMARK_BATCH_SIZES = [1, 4, 16, 64, 256, 1024, 4096]
+INFERENCE_BATCH_SIZE = 1024 # contexts per forward pass
+
+
+def hierarchical_paths(model):
+    '''
+    Huffman paths of all words as one flat index into the table [logsigmoid(-scores), logsigmoid(scores)]
+    of the inner nodes, the offsets mark where the path of each word starts
+    '''
+    mask = model.hs_mask.bool()
+    path_columns = (model.hs_points + model.hs_codes.long() * (model.vocab_size - 1))[mask]
+    path_offsets = torch.cat([torch.zeros(1, dtype=torch.long, device=mask.device), mask.sum(dim=1).cumsum(0)[:-1]])
+    return path_columns, path_offsets
+
+
+class TOPK_CBOW(nn.Module):
+    '''
+    CBOW forward pass followed by the top-k selection, this is what gets exported with TorchScript.
+    Returns the log probabilities and word indices of the k most likely center words.
+    CBOW.forward builds the hierarchical softmax path scores of every word as a (batch, vocab, depth)
+    tensor, here the log probability of a word is summed from a (2 * inner nodes, batch) table
+    with one embedding_bag over the paths, which needs no more memory than the softmax output
+    '''
+    def __init__(self, model, topk):
+        super(TOPK_CBOW, self).__init__()
+        self.model = model
+        self.topk = topk
+        if model.output_layer == 'hierarchical_softmax':
+            path_columns, path_offsets = hierarchical_paths(model)
+            self.register_buffer('path_columns', path_columns, persistent=False)
+            self.register_buffer('path_offsets', path_offsets, persistent=False)
+
+    def forward(self, contexts):
+        if self.model.output_layer != 'hierarchical_softmax':
+            return torch.topk(self.model(contexts), self.topk, dim=1)
+        # one row per inner node and one column per context, so each path sums whole rows
+        node_scores = self.model.node_embeddings.weight @ self.model.hidden(contexts).t()
+        table = torch.cat([F.logsigmoid(-node_scores), F.logsigmoid(node_scores)], dim=0)
+        log_probs = F.embedding_bag(self.path_columns, table, self.path_offsets, mode='sum')
+        values, words = torch.topk(log_probs, self.topk, dim=0)
+        return values.t(), words.t()
+
+
+class CBOW_PREDICTOR():
+    '''
+    Loads a CBOW checkpoint once and predicts center words for batches of contexts
+    without autograd
+    '''
+    def __init__(self, checkpoint_file, unique_vocab=None, device=None):
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        checkpoint = load_checkpoint(checkpoint_file)
+        state_dict = checkpoint['state_dict']
+        if 'lin1.weight' not in state_dict:
+            raise ValueError('{} is not a CBOW checkpoint'.format(checkpoint_file))
+        if unique_vocab is None:
+            if 'vocab' not in checkpoint:
+                raise ValueError('{} has no vocabulary, pass the vocabulary of the encoded corpus'.format(checkpoint_file))
+            unique_vocab = checkpoint['vocab']
+        self.unique_vocab = list(unique_vocab)
+        self.word_to_idx = {w: i for i, w in enumerate(self.unique_vocab)}
+
+        vocab_size, embedding_size = state_dict['embeddings.weight'].shape
+        self.context_size = state_dict['lin1.weight'].shape[1] // (2 * embedding_size)
+        if 'lin2.weight' in state_dict:
+            output_layer = 'softmax'
+        elif 'out_embeddings.weight' in state_dict:
+            output_layer = 'negative_sampling'
+        else:
+            output_layer = 'hierarchical_softmax'
+        # the word counts only define the noise table and the Huffman tree, the noise table is not used here
+        word_counts = checkpoint['word_counts'].numpy() if 'word_counts' in checkpoint else np.ones(vocab_size)
+        if output_layer == 'hierarchical_softmax' and 'word_counts' not in checkpoint:
+            raise ValueError('{} has no word counts, the Huffman tree can not be rebuilt'.format(checkpoint_file))
+        model = CBOW(vocab_size, embedding_size, self.context_size, output_layer, word_counts)
+        model.load_state_dict(state_dict)
+        model.eval()
+        for parameter in model.parameters():
+            parameter.requires_grad = False
+        self.model = model.to(self.device)
+        # TOPK_CBOW per k, the hierarchical softmax paths are indexed once
+        self.topk_models = {}
+
+    def encode(self, contexts):
+        '''
+        Returns the int64 word indices of a list of contexts (lists of words)
+        '''
+        if len(contexts) == 0:
+            return np.zeros((0, 2 * self.context_size), dtype=np.int64)
+        try:
+            ids = [[self.word_to_idx[word] for word in context] for context in contexts]
+        except KeyError as error:
+            raise KeyError('{} is not in the vocabulary'.format(error.args[0]))
+        ids = np.array(ids, dtype=np.int64).reshape(len(ids), -1)
+        if ids.shape[1] != 2 * self.context_size:
+            raise ValueError('contexts need {} words, got {}'.format(2 * self.context_size, ids.shape[1]))
+        return ids
+
+    def predict_ids(self, contexts, topk=5, batch_size=INFERENCE_BATCH_SIZE):
+        '''
+        Top-k center words for an array of encoded contexts of shape (n, 2*context_size).
+        Returns the word indices and log probabilities, both of shape (n, topk)
+        '''
+        contexts = torch.as_tensor(np.asarray(contexts, dtype=np.int64))
+        if topk not in self.topk_models:
+            self.topk_models[topk] = TOPK_CBOW(self.model, topk)
+        topk_model = self.topk_models[topk]
+        indices, log_probs = [], []
+        with torch.inference_mode():
+            for start in range(0, len(contexts), batch_size):
+                batch = contexts[start:start + batch_size].to(self.device, non_blocking=True)
+                values, words = topk_model(batch)
+                indices.append(words.cpu())
+                log_probs.append(values.cpu())
+        if not indices:
+            return np.zeros((0, topk), dtype=np.int64), np.zeros((0, topk), dtype=np.float32)
+        return torch.cat(indices).numpy(), torch.cat(log_probs).numpy()
+
+    def predict(self, contexts, topk=5, batch_size=INFERENCE_BATCH_SIZE):
+        '''
+        Top-k center words for a list of contexts (lists of words),
+        returns a list of (word, probability) lists, most likely word first
+        '''
+        indices, log_probs = self.predict_ids(self.encode(contexts), topk, batch_size)
+        return [[(self.unique_vocab[i], float(np.exp(p))) for i, p in zip(row, row_probs)]
+                for row, row_probs in zip(indices, log_probs)]
+
+    def export_torchscript(self, filename, topk=5):
+        '''
+        Trace the forward pass with top-k selection and save it as TorchScript,
+        the exported module takes int64 contexts of shape (batch, 2*context_size)
+        '''
+        example = torch.zeros(2, 2 * self.context_size, dtype=torch.long, device=self.device)
+        with torch.inference_mode(False), torch.no_grad():
+            traced = torch.jit.trace(TOPK_CBOW(self.model, topk), example)
+        traced.save(filename)
+        return traced
+
+    def benchmark(self, batch_sizes=BENCHMARK_BATCH_SIZES, num_contexts=16384, topk=5, min_seconds=0.5):
+        '''
+        Print the contexts/sec of predict_ids for every batch size on random contexts
+        '''
+        contexts = np.random.randint(len(self.unique_vocab), size=(num_contexts, 2 * self.context_size))
+        results = {}
+        print('batch size  contexts/sec')
+        for batch_size in batch_sizes:
+            # warm up, then repeat until the measurement is long enough
+            self.predict_ids(contexts[:batch_size], topk, batch_size)
+            predicted, start_time = 0, time.perf_counter()
+            while True:
+                count = min(num_contexts, 256 * batch_size)
+                self.predict_ids(contexts[:count], topk, batch_size)
+                predicted += count
+                seconds = time.perf_counter() - start_time
+                if seconds >= min_seconds:
+                    break
+            results[batch_size] = predicted / seconds
+            print('{:10d}  {:12.0f}'.format(batch_size, results[batch_size]))
+        return results
+
+
+def read_contexts(filename):
+    '''
+    Returns the contexts of a file with one context per line
+    '''
+    with open(filename, 'r', encoding='utf8') as file:
+        return [line.lower().split() for line in file if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict center words with a trained CBOW checkpoint')
+    parser.add_argument('checkpoint', help='training checkpoint (.pth)')
+    parser.add_argument('--vocab', help='vocabulary .npy of the encoded corpus, for checkpoints without vocabulary')
+    parser.add_argument('--contexts', help='file with one context per line')
+    parser.add_argument('--topk', type=int, default=5, help='number of predicted center words per context')
+    parser.add_argument('--batch-size', type=int, default=INFERENCE_BATCH_SIZE)
+    parser.add_argument('--torchscript', help='export the model with top-k selection as TorchScript to this file')
+    parser.add_argument('--benchmark', action='store_true', help='report contexts/sec for batch sizes 1..4096')
+    args = parser.parse_args()
+    unique_vocab = np.load(args.vocab).tolist() if args.vocab else None
+    predictor = CBOW_PREDICTOR(args.checkpoint, unique_vocab)
+    if args.contexts:
+        contexts = read_contexts(args.contexts)
+        for context, prediction in zip(contexts, predictor.predict(contexts, args.topk, args.batch_size)):
+            print(' '.join(context), '->', ', '.join('{} ({:.3f})'.format(word, p) for word, p in prediction))
+    if args.torchscript:
+        predictor.export_torchscript(args.torchscript, args.topk)
+        print('TorchScript module written to {}'.format(args.torchscript))
+    if args.benchmark:
+        predictor.benchmark(topk=args.topk)
+
+if __name__ == "__main__": main()
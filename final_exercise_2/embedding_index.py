@@ -0,0 +1,326 @@
+"""
+Approximate nearest neighbour search over trained word embeddings.
+The indexes only need the embedding matrix and the vocabulary, they do not depend on torch.
+IVF_INDEX reduces the number of scored words, INT8_INDEX and PQ_INDEX reduce the
+memory of the embeddings by searching on quantised codes.
+"""
+import time
+import numpy as np
+
+KMEANS_ITERATIONS = 10 # Lloyd iterations used when building the inverted lists
+DEFAULT_PROBES = 8 # number of inverted lists scanned per query
+PQ_SUBSPACES = 10 # number of sub vectors (one byte each) per word in product quantisation
+SEARCH_BLOCK = 65536 # rows of quantised codes decoded at once during search
+
+
+def normalize_rows(matrix):
+    '''
+    Returns a float32 copy of matrix with unit length rows
+    '''
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-6)
+
+
+def top_k(scores, topn):
+    '''
+    Returns the indices of the topn largest scores, largest first
+    '''
+    topn = min(topn, len(scores))
+    candidates = np.argpartition(-scores, topn - 1)[:topn]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class IVF_INDEX():
+    '''
+    Inverted file index for cosine similarity.
+    The normalised embeddings are partitioned with spherical k-means, a query
+    only scores the words in the num_probes lists whose centroids are closest.
+    '''
+    def __init__(self, num_lists=None, num_probes=DEFAULT_PROBES, seed=0):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.seed = seed
+
+    def build(self, embeddings, unique_vocab, iterations=KMEANS_ITERATIONS):
+        '''
+        Build the index from an embedding matrix (vocab_size x embedding_size).
+        Without an explicit num_lists about sqrt(vocab_size) lists are used
+        '''
+        self.normalized = normalize_rows(embeddings)
+        self.unique_vocab = list(unique_vocab)
+        self.word_to_idx = {w: i for i, w in enumerate(self.unique_vocab)}
+        vocab_size = len(self.normalized)
+        if self.num_lists is None:
+            self.num_lists = max(1, int(np.sqrt(vocab_size)))
+        self.num_lists = min(self.num_lists, vocab_size)
+
+        rng = np.random.default_rng(self.seed)
+        centroids = self.normalized[rng.choice(vocab_size, self.num_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(self.normalized @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, self.normalized)
+            counts = np.bincount(assignment, minlength=self.num_lists)
+            # restart empty lists from random words
+            empty = counts == 0
+            sums[empty] = self.normalized[rng.choice(vocab_size, int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        assignment = np.argmax(self.normalized @ centroids.T, axis=1)
+
+        self.centroids = centroids
+        # word indices grouped by list, list i is members[offsets[i]:offsets[i + 1]]
+        self.members = np.argsort(assignment, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=self.num_lists))])
+        return self
+
+    def search(self, vector, topn=5, exclude=None):
+        '''
+        Returns the indices and cosine similarities of the topn words closest to vector.
+        A word index given as exclude is never returned
+        '''
+        vector = normalize_rows(np.reshape(vector, (1, -1)))[0]
+        probes = top_k(self.centroids @ vector, self.num_probes)
+        candidates = np.concatenate([self.members[self.offsets[i]:self.offsets[i + 1]] for i in probes])
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        scores = self.normalized[candidates] @ vector
+        best = top_k(scores, topn)
+        return candidates[best], scores[best]
+
+    def most_similar(self, words, topn=5):
+        '''
+        Returns the topn (word, cosine similarity) pairs closest to word, most similar first.
+        words can also be a list of words, then a list of results is returned
+        '''
+        single_query = isinstance(words, str)
+        if single_query:
+            words = [words]
+        results = []
+        for word in words:
+            i = self.word_to_idx[word]
+            indices, scores = self.search(self.normalized[i], topn, exclude=i)
+            results.append([(self.unique_vocab[j], float(s)) for j, s in zip(indices, scores)])
+        return results[0] if single_query else results
+
+    def save(self, filename):
+        '''
+        Write the index to a single .npz file
+        '''
+        np.savez(filename, normalized=self.normalized, vocab=np.array(self.unique_vocab),
+                 centroids=self.centroids, members=self.members, offsets=self.offsets,
+                 num_probes=self.num_probes, seed=self.seed)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Read an index written by save
+        '''
+        data = np.load(filename)
+        index = cls(len(data['centroids']), int(data['num_probes']), int(data['seed']))
+        index.normalized = data['normalized']
+        index.unique_vocab = data['vocab'].tolist()
+        index.word_to_idx = {w: i for i, w in enumerate(index.unique_vocab)}
+        index.centroids = data['centroids']
+        index.members = data['members']
+        index.offsets = data['offsets']
+        return index
+
+
+def kmeans(data, num_clusters, iterations=KMEANS_ITERATIONS, seed=0):
+    '''
+    Euclidean k-means, returns the centroids and the cluster of every row of data
+    '''
+    def nearest(centroids):
+        # the squared norm of the rows does not change the argmin
+        return np.argmin((centroids ** 2).sum(axis=1) - 2 * data @ centroids.T, axis=1)
+
+    rng = np.random.default_rng(seed)
+    num_clusters = min(num_clusters, len(data))
+    centroids = data[rng.choice(len(data), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()))]
+    return centroids.astype(np.float32), nearest(centroids)
+
+
+class QUANTIZED_INDEX():
+    '''
+    Exact top-k search over quantised, row normalised embeddings.
+    Subclasses implement quantize (build the codes) and scores (similarity of a
+    query with a block of rows, computed from the codes)
+    '''
+    def build(self, embeddings, unique_vocab):
+        normalized = normalize_rows(embeddings)
+        self.unique_vocab = list(unique_vocab)
+        self.word_to_idx = {w: i for i, w in enumerate(self.unique_vocab)}
+        self.vocab_size, self.embedding_size = normalized.shape
+        self.quantize(normalized)
+        return self
+
+    def search(self, vector, topn=5, exclude=None):
+        '''
+        Returns the indices and approximate cosine similarities of the topn words closest to vector
+        '''
+        vector = normalize_rows(np.reshape(vector, (1, -1)))[0]
+        scores = np.concatenate([self.scores(vector, start, min(start + SEARCH_BLOCK, self.vocab_size))
+                                 for start in range(0, self.vocab_size, SEARCH_BLOCK)])
+        if exclude is not None:
+            scores[exclude] = -np.inf
+        best = top_k(scores, topn)
+        return best, scores[best]
+
+    def most_similar(self, words, topn=5):
+        '''
+        Returns the topn (word, cosine similarity) pairs closest to word, most similar first.
+        words can also be a list of words, then a list of results is returned
+        '''
+        single_query = isinstance(words, str)
+        if single_query:
+            words = [words]
+        results = []
+        for word in words:
+            i = self.word_to_idx[word]
+            indices, scores = self.search(self.reconstruct(i), topn, exclude=i)
+            results.append([(self.unique_vocab[j], float(s)) for j, s in zip(indices, scores)])
+        return results[0] if single_query else results
+
+
+class INT8_INDEX(QUANTIZED_INDEX):
+    '''
+    Scalar quantisation, every vector is stored as int8 codes with one float32 scale per row
+    '''
+    def quantize(self, normalized):
+        self.scales = np.maximum(np.abs(normalized).max(axis=1), 1e-6) / 127.0
+        self.codes = np.round(normalized / self.scales[:, None]).astype(np.int8)
+
+    def scores(self, vector, start, end):
+        return (self.codes[start:end] @ vector) * self.scales[start:end]
+
+    def reconstruct(self, i):
+        return self.codes[i] * self.scales[i]
+
+    def memory_bytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def save(self, filename):
+        np.savez(filename, codes=self.codes, scales=self.scales, vocab=np.array(self.unique_vocab))
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        index = cls()
+        index.codes, index.scales = data['codes'], data['scales']
+        index.unique_vocab = data['vocab'].tolist()
+        index.word_to_idx = {w: i for i, w in enumerate(index.unique_vocab)}
+        index.vocab_size, index.embedding_size = index.codes.shape
+        return index
+
+
+class PQ_INDEX(QUANTIZED_INDEX):
+    '''
+    Product quantisation, every vector is split into num_subspaces parts and each part
+    is replaced by the index of its nearest centroid (one byte). Queries are scored
+    with a lookup table of query part x centroid dot products
+    '''
+    def __init__(self, num_subspaces=PQ_SUBSPACES, num_centroids=256, seed=0):
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.seed = seed
+
+    def quantize(self, normalized):
+        self.splits = np.array_split(np.arange(self.embedding_size), self.num_subspaces)
+        self.codebooks = []
+        self.codes = np.empty((self.vocab_size, len(self.splits)), dtype=np.uint8)
+        for m, dims in enumerate(self.splits):
+            centroids, assignment = kmeans(normalized[:, dims], self.num_centroids, seed=self.seed + m)
+            self.codebooks.append(centroids)
+            self.codes[:, m] = assignment
+
+    def scores(self, vector, start, end):
+        codes = self.codes[start:end]
+        scores = np.zeros(end - start, dtype=np.float32)
+        for m, dims in enumerate(self.splits):
+            table = self.codebooks[m] @ vector[dims]
+            scores += table[codes[:, m]]
+        return scores
+
+    def reconstruct(self, i):
+        return np.concatenate([self.codebooks[m][self.codes[i, m]] for m in range(len(self.splits))])
+
+    def memory_bytes(self):
+        return self.codes.nbytes + sum(codebook.nbytes for codebook in self.codebooks)
+
+    def save(self, filename):
+        arrays = {'codebook{}'.format(m): codebook for m, codebook in enumerate(self.codebooks)}
+        np.savez(filename, codes=self.codes, vocab=np.array(self.unique_vocab),
+                 embedding_size=self.embedding_size, seed=self.seed, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        codes = data['codes']
+        index = cls(codes.shape[1], len(data['codebook0']), int(data['seed']))
+        index.codes = codes
+        index.codebooks = [data['codebook{}'.format(m)] for m in range(codes.shape[1])]
+        index.unique_vocab = data['vocab'].tolist()
+        index.word_to_idx = {w: i for i, w in enumerate(index.unique_vocab)}
+        index.vocab_size, index.embedding_size = len(codes), int(data['embedding_size'])
+        index.splits = np.array_split(np.arange(index.embedding_size), index.num_subspaces)
+        return index
+
+
+def benchmark_quantization(index, embeddings, exact_search, num_queries=200, topn=5, seed=0):
+    '''
+    Compare a quantised index with the float32 embeddings. exact_search(word, topn)
+    returns the reference (word, similarity) list, e.g. get_closest_word.
+    Returns memory reduction, query time of both in milliseconds and the top-k overlap
+    '''
+    rng = np.random.default_rng(seed)
+    queries = [index.unique_vocab[i] for i in rng.choice(index.vocab_size, min(num_queries, index.vocab_size), replace=False)]
+
+    start_time = time.time()
+    exact = [exact_search(word, topn) for word in queries]
+    exact_time = (time.time() - start_time) / len(queries)
+    start_time = time.time()
+    approximate = [index.most_similar(word, topn) for word in queries]
+    index_time = (time.time() - start_time) / len(queries)
+
+    overlap = np.mean([len({w for w, _ in e} & {w for w, _ in a}) / float(len(e)) for e, a in zip(exact, approximate)])
+    float_bytes = np.asarray(embeddings, dtype=np.float32).nbytes
+    reduction = float_bytes / float(index.memory_bytes())
+    print("{}: {:.2f} MB -> {:.2f} MB ({:.1f}x smaller), exact {:.3f} ms/query, quantised {:.3f} ms/query, top-{} overlap {:.3f}".format(
+        type(index).__name__, float_bytes / 2**20, index.memory_bytes() / 2**20, reduction, 1000 * exact_time, 1000 * index_time, topn, overlap))
+    return reduction, 1000 * exact_time, 1000 * index_time, overlap
+
+
+def benchmark_index(index, num_queries=200, topn=10, seed=0):
+    '''
+    Compare the index with exact brute force search on random query words.
+    Returns recall@topn and the average query time of both in milliseconds
+    '''
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(index.unique_vocab), min(num_queries, len(index.unique_vocab)), replace=False)
+
+    start_time = time.time()
+    exact = []
+    for i in queries:
+        scores = index.normalized @ index.normalized[i]
+        scores[i] = -np.inf
+        exact.append(top_k(scores, topn))
+    exact_time = (time.time() - start_time) / len(queries)
+
+    start_time = time.time()
+    approximate = [index.search(index.normalized[i], topn, exclude=i)[0] for i in queries]
+    index_time = (time.time() - start_time) / len(queries)
+
+    hits = sum(len(np.intersect1d(e, a)) for e, a in zip(exact, approximate))
+    recall = hits / float(sum(len(e) for e in exact))
+    print("recall@{} {:.3f}, exact {:.3f} ms/query, index {:.3f} ms/query ({} lists, {} probes)".format(
+        topn, recall, 1000 * exact_time, 1000 * index_time, index.num_lists, index.num_probes))
+    return recall, 1000 * exact_time, 1000 * index_time
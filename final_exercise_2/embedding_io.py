@@ -0,0 +1,122 @@
+"""
+Export and import of trained word embeddings.
+
+The native format is a single file which can be memory mapped:
+    header     magic, dtype, vocab size, embedding size, size of the vocabulary block
+    vocabulary utf-8 words separated by newlines
+    matrix     vocab size x embedding size, float16 or float32, aligned to 64 bytes
+The word2vec text and binary formats are supported for use with other tools.
+"""
+import struct
+import numpy as np
+
+MAGIC = b'CBOWEMB1'
+HEADER = struct.Struct('<8sBxxxIIQ')
+ALIGNMENT = 64
+DTYPES = {0: np.float32, 1: np.float16}
+
+
+def matrix_offset(vocab_bytes):
+    '''
+    Offset of the matrix in the file, the header and vocabulary are padded to ALIGNMENT
+    '''
+    end = HEADER.size + vocab_bytes
+    return (end + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_embeddings(filename, weights, unique_vocab, dtype=np.float32):
+    '''
+    Write vocabulary and embedding matrix into one memory mappable file.
+    Row i of weights is the vector of unique_vocab[i]
+    '''
+    weights = np.asarray(weights)
+    dtype_code = [code for code, value in DTYPES.items() if value == np.dtype(dtype)][0]
+    if len(weights) != len(unique_vocab):
+        raise ValueError('{} rows for a vocabulary of {} words'.format(len(weights), len(unique_vocab)))
+    vocabulary = '\n'.join(unique_vocab).encode('utf8')
+    with open(filename, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, dtype_code, weights.shape[0], weights.shape[1], len(vocabulary)))
+        file.write(vocabulary)
+        file.write(b'\0' * (matrix_offset(len(vocabulary)) - HEADER.size - len(vocabulary)))
+        file.write(np.ascontiguousarray(weights, dtype=DTYPES[dtype_code]).tobytes())
+
+
+class EMBEDDING_FILE():
+    '''
+    Lazily opened embedding file written by write_embeddings.
+    The matrix is a read-only np.memmap, vocabulary and word index are only
+    decoded when they are used first, so opening costs the same for any vocabulary size
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            magic, dtype_code, vocab_size, embedding_size, self.vocab_bytes = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not an embedding file'.format(filename))
+        self.matrix = np.memmap(filename, dtype=DTYPES[dtype_code], mode='r',
+                                offset=matrix_offset(self.vocab_bytes), shape=(vocab_size, embedding_size))
+        self.cached_vocab = None
+        self.cached_word_to_idx = None
+
+    @property
+    def unique_vocab(self):
+        if self.cached_vocab is None:
+            vocabulary = np.memmap(self.filename, dtype=np.uint8, mode='r', offset=HEADER.size, shape=(self.vocab_bytes,))
+            self.cached_vocab = bytes(vocabulary).decode('utf8').split('\n') if self.vocab_bytes else []
+        return self.cached_vocab
+
+    @property
+    def word_to_idx(self):
+        if self.cached_word_to_idx is None:
+            self.cached_word_to_idx = {w: i for i, w in enumerate(self.unique_vocab)}
+        return self.cached_word_to_idx
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def vector(self, word):
+        '''
+        Returns the embedding of word as float32 array
+        '''
+        return np.asarray(self.matrix[self.word_to_idx[word]], dtype=np.float32)
+
+
+def write_word2vec(filename, weights, unique_vocab, binary=False):
+    '''
+    Write the embeddings in the word2vec text or binary format
+    '''
+    weights = np.asarray(weights, dtype=np.float32)
+    with open(filename, 'wb') as file:
+        file.write('{} {}\n'.format(weights.shape[0], weights.shape[1]).encode('utf8'))
+        for word, vector in zip(unique_vocab, weights):
+            if binary:
+                file.write(word.encode('utf8') + b' ' + vector.astype('<f4').tobytes() + b'\n')
+            else:
+                file.write((word + ' ' + ' '.join('{:.6f}'.format(value) for value in vector) + '\n').encode('utf8'))
+
+
+def read_word2vec(filename, binary=False):
+    '''
+    Read embeddings in the word2vec text or binary format.
+    Returns the vocabulary and the float32 matrix
+    '''
+    with open(filename, 'rb') as file:
+        vocab_size, embedding_size = map(int, file.readline().split())
+        unique_vocab = []
+        weights = np.empty((vocab_size, embedding_size), dtype=np.float32)
+        for i in range(vocab_size):
+            if binary:
+                word = bytearray()
+                char = file.read(1)
+                while char != b' ':
+                    # skip the newline which ends the previous vector
+                    if char != b'\n':
+                        word += char
+                    char = file.read(1)
+                unique_vocab.append(word.decode('utf8'))
+                weights[i] = np.frombuffer(file.read(4 * embedding_size), dtype='<f4')
+            else:
+                parts = file.readline().decode('utf8').rstrip().split(' ')
+                unique_vocab.append(parts[0])
+                weights[i] = np.array(parts[1:], dtype=np.float32)
+    return unique_vocab, weights
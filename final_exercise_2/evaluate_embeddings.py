@@ -0,0 +1,173 @@
+"""
+Word similarity and analogy benchmarks for trained embeddings.
+
+Usage:
+    python evaluate_embeddings.py checkpoint.pth --vocab preprocessing-cache/encoded-corpus-<hash>_vocab.npy --similarity word-similarity.tsv --analogy word-analogies.tsv
+
+The embeddings can be a training checkpoint (.pth), an exported embedding file (.cbow)
+or a word2vec file (.txt / .bin). Checkpoints written during training contain the
+vocabulary, older checkpoints need the vocabulary file of the encoded corpus.
+Similarity files have the columns word1, word2, score; analogy files a, b, c, d
+for "a is to b as c is to d". Lines starting with # are ignored.
+"""
+import argparse
+import time
+import numpy as np
+
+from embedding_index import normalize_rows
+from embedding_io import EMBEDDING_FILE, read_word2vec
+
+ANALOGY_BATCH_SIZE = 512 # analogy questions scored with one matrix product
+
+
+def read_tsv(filename, columns):
+    '''
+    Returns the rows of a tab (or space) separated file with the given number of columns
+    '''
+    rows = []
+    with open(filename, 'r', encoding='utf8') as file:
+        for line in file:
+            parts = line.split('\t') if '\t' in line else line.split()
+            parts = [part.strip() for part in parts]
+            if len(parts) >= columns and not parts[0].startswith('#'):
+                rows.append(parts[:columns])
+    return rows
+
+
+def load_similarity_tsv(filename):
+    '''
+    Returns a list of (word1, word2, score), a header line is skipped
+    '''
+    pairs = []
+    for word_1, word_2, score in read_tsv(filename, 3):
+        try:
+            pairs.append((word_1.lower(), word_2.lower(), float(score)))
+        except ValueError:
+            continue
+    return pairs
+
+
+def load_analogy_tsv(filename):
+    '''
+    Returns a list of (a, b, c, d) analogy questions
+    '''
+    return [tuple(word.lower() for word in row) for row in read_tsv(filename, 4)]
+
+
+def load_embeddings(filename, vocab_file=None):
+    '''
+    Returns the embedding matrix and vocabulary stored in a checkpoint, an exported
+    embedding file or a word2vec file
+    '''
+    if filename.endswith('.cbow'):
+        embeddings = EMBEDDING_FILE(filename)
+        return np.asarray(embeddings.matrix, dtype=np.float32), embeddings.unique_vocab
+    if filename.endswith('.txt') or filename.endswith('.bin'):
+        unique_vocab, weights = read_word2vec(filename, binary=filename.endswith('.bin'))
+        return weights, unique_vocab
+    import torch
+    checkpoint = torch.load(filename, map_location='cpu')
+    weights = checkpoint['state_dict']['embeddings.weight'].numpy()
+    if vocab_file is not None:
+        unique_vocab = np.load(vocab_file).tolist()
+    elif 'vocab' in checkpoint:
+        unique_vocab = checkpoint['vocab']
+    else:
+        raise ValueError('{} has no vocabulary, pass the vocabulary file of the encoded corpus'.format(filename))
+    return weights, unique_vocab
+
+
+def rank(values):
+    '''
+    Ranks of values starting at 0, ties get their average rank
+    '''
+    order = np.argsort(values, kind='mergesort')
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(len(values))
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return (np.bincount(inverse, weights=ranks) / counts)[inverse]
+
+
+def spearman(x, y):
+    '''
+    Spearman rank correlation of two sequences
+    '''
+    if len(x) < 2:
+        return float('nan')
+    return float(np.corrcoef(rank(np.asarray(x)), rank(np.asarray(y)))[0, 1])
+
+
+class EVALUATOR():
+    '''
+    Runs the benchmarks on an embedding matrix, all questions of a suite are
+    answered with vectorised operations on the row normalised matrix
+    '''
+    def __init__(self, embeddings, unique_vocab):
+        self.normalized = normalize_rows(embeddings)
+        self.unique_vocab = list(unique_vocab)
+        self.word_to_idx = {w: i for i, w in enumerate(self.unique_vocab)}
+
+    def word_similarity(self, pairs):
+        '''
+        Spearman correlation between cosine similarity and the human scores.
+        Pairs with unknown words are skipped, returns (correlation, pairs used, seconds)
+        '''
+        start_time = time.time()
+        known = [(self.word_to_idx[a], self.word_to_idx[b], score) for a, b, score in pairs
+                 if a in self.word_to_idx and b in self.word_to_idx]
+        if not known:
+            return float('nan'), 0, time.time() - start_time
+        first, second, scores = (np.array(column) for column in zip(*known))
+        cosine = (self.normalized[first] * self.normalized[second]).sum(axis=1)
+        return spearman(cosine, scores), len(known), time.time() - start_time
+
+    def analogy(self, questions, batch_size=ANALOGY_BATCH_SIZE):
+        '''
+        3CosAdd analogy accuracy: the answer to a:b :: c:? is the word closest to b - a + c,
+        the three question words excluded. Questions with unknown words are skipped,
+        returns (accuracy, questions used, seconds)
+        '''
+        start_time = time.time()
+        known = np.array([[self.word_to_idx[w] for w in question] for question in questions
+                          if all(w in self.word_to_idx for w in question)], dtype=np.int64).reshape(-1, 4)
+        correct = 0
+        for start in range(0, len(known), batch_size):
+            batch = known[start:start + batch_size]
+            targets = normalize_rows(self.normalized[batch[:, 1]] - self.normalized[batch[:, 0]] + self.normalized[batch[:, 2]])
+            scores = targets @ self.normalized.T
+            rows = np.arange(len(batch))
+            for column in range(3):
+                scores[rows, batch[:, column]] = -np.inf
+            correct += int((np.argmax(scores, axis=1) == batch[:, 3]).sum())
+        accuracy = correct / float(len(known)) if len(known) else float('nan')
+        return accuracy, len(known), time.time() - start_time
+
+    def run(self, similarity_file=None, analogy_file=None):
+        '''
+        Run the suites given as files and print their results
+        '''
+        results = {}
+        if similarity_file is not None:
+            pairs = load_similarity_tsv(similarity_file)
+            correlation, used, seconds = self.word_similarity(pairs)
+            print("word similarity: spearman {:.4f} on {}/{} pairs ({:.3f} s)".format(correlation, used, len(pairs), seconds))
+            results['similarity'] = correlation
+        if analogy_file is not None:
+            questions = load_analogy_tsv(analogy_file)
+            accuracy, used, seconds = self.analogy(questions)
+            print("analogy: accuracy {:.4f} on {}/{} questions ({:.3f} s)".format(accuracy, used, len(questions), seconds))
+            results['analogy'] = accuracy
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate word embeddings on similarity and analogy suites')
+    parser.add_argument('embeddings', help='checkpoint (.pth), exported embeddings (.cbow) or word2vec file (.txt/.bin)')
+    parser.add_argument('--vocab', help='vocabulary .npy of the encoded corpus, for checkpoints without vocabulary')
+    parser.add_argument('--similarity', help='word similarity TSV file')
+    parser.add_argument('--analogy', help='analogy TSV file')
+    args = parser.parse_args()
+    weights, unique_vocab = load_embeddings(args.embeddings, args.vocab)
+    EVALUATOR(weights, unique_vocab).run(args.similarity, args.analogy)
+
+if __name__ == "__main__": main()
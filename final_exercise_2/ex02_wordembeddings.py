@@ -4,71 +4,241 @@ from torch.autograd import Variable
 from torch.optim import SGD, Adam
 import torch.nn.functional as F
 import os
+import math
+import time
+import csv
+import json
+import hashlib
+import contextlib
+import heapq
+import queue
+import threading
+import multiprocessing
+import copy
+import torch.multiprocessing
 import nltk
 import string
+from collections import Counter
 from nltk.probability import FreqDist
-from nltk.tokenize.treebank import TreebankWordDetokenizer
 from nltk.corpus import stopwords 
 from nltk.tokenize import word_tokenize 
 import matplotlib.pyplot as plt
 import numpy as np
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is not reported there
+    resource = None
+from embedding_index import IVF_INDEX, INT8_INDEX, PQ_INDEX, benchmark_index, benchmark_quantization
+from embedding_io import write_embeddings, write_word2vec
+from evaluate_embeddings import EVALUATOR
 
 # check for the availability of GPU with CUDA support
 cuda_available = torch.cuda.is_available()
 print(cuda_available)
 
 RESUME_TRAINING = True # determines if training should be continued if a checkpoint is available
+INCREMENTAL_CORPUS_FILE = None # new text trained into the checkpoint, its new words are added to the vocabulary
+INCREMENTAL_EPOCHS = 5 # epochs trained on the new text only
 USE_ADAM = False # Switch between optimizer adam and sgd
+SPARSE_GRADIENTS = False # Switch for sparse embedding gradients (SparseAdam / sparse SGD for the embedding tables)
+RUN_BENCHMARKS = False # Switch for running the training throughput benchmarks before training
 PLOT_DATA = False   # Switch for plotting word frequency distributions
 DEBUG_PRINT = False # Switch for printing debug info
 DETAILED_DEBUG_PRINT = False # Swith for printing special checkpoint information at each epoch
 REMOVE_RARE_WORDS = True # Switch for enabling rare words removal 
+MIN_WORD_COUNT = 6 # words occurring less often than this are removed as rare words
+NUM_WORKERS = 1 # number of processes used for corpus preprocessing, 1 disables the process pool
+BATCH_TRAINING = True # Switch between mini-batched training and the original per-sample training loop
 
 CONTEXT_SIZE = 5
 EMBEDDING_DIM = 20
+HIDDEN_DIM = 50
+MODEL_TYPE = 'cbow' # 'cbow' or 'skipgram', both train on the same encoded context windows
+OUTPUT_LAYER = 'softmax' # output layer of CBOW: 'softmax', 'negative_sampling' or 'hierarchical_softmax'
+NEGATIVE_SAMPLES = 5 # noise words per context with negative sampling
+NOISE_TABLE_SIZE = 10**6 # size of the unigram^0.75 table negative samples are drawn from
 CONTEXT_SIZE_5 = 5
 
 EPOCH = 50
 VERVOSE = 5
+CHECKPOINT_EVERY_EPOCHS = 1 # write a checkpoint every N epochs
+CHECKPOINT_EVERY_SECONDS = None # additionally write a checkpoint when this many seconds passed since the last one
+CHECKPOINT_KEEP_LAST = 3 # number of per-epoch checkpoint files kept besides the latest checkpoint
+TRAINING_LOG_FILE = 'training-log.csv' # per epoch timing of the training phases, .csv or .json
+PROFILE_EPOCH = None # epoch which is additionally recorded with torch.profiler
+LR_SCHEDULE = None # None (constant), 'linear' or 'cosine' decay of the learning rate over all epochs
+MIN_LR_FACTOR = 1e-4 # the decayed learning rate never drops below this fraction of the initial one
+VALIDATION_FRACTION = 0.02 # fraction of the context windows held out for the validation loss, 0 disables it
+EARLY_STOPPING_PATIENCE = 3 # stop after this many epochs without validation loss improvement, None disables it
+EARLY_STOPPING_MIN_DELTA = 1e-3 # smaller validation loss improvements do not count
+VALIDATION_BATCH_SIZE = 1024 # contexts per forward pass when computing the validation loss
+VALIDATION_SEED = 0 # seed of the negative samples of the validation loss, every epoch is scored against the same noise words
+BATCH_SIZE = 64 # number of contexts per optimizer step in batched training
+NUM_TRAINING_PROCESSES = 1 # CPU processes for Hogwild training on shared parameters, 1 trains in the main process
+HOGWILD_POLL_SECONDS = 1.0 # interval in which the main process checks for failed hogwild workers
+SUBSAMPLE_FREQUENT_WORDS = False # Switch for word2vec style subsampling of windows centred on frequent words
+SUBSAMPLE_THRESHOLD = 1e-3 # words with a corpus frequency above this are dropped with growing probability
+CORPUS_FILE = 'shakespeare-corpus.txt'
+ENCODED_CORPUS_PREFIX = 'encoded-corpus' # file prefix of the persisted token array and vocabulary
+USE_PREPROCESSING_CACHE = True # Switch for reusing the cleaned and encoded corpus of an earlier run
+PREPROCESSING_CACHE_DIR = 'preprocessing-cache' # cached corpora are named by a hash of the corpus and the cleanup switches
+PREPROCESSING_CACHE_VERSION = 2 # increase when the cleanup code changes, old cache entries are then ignored
+USE_ANN_INDEX = False # Switch for answering closest word queries from an approximate nearest neighbour index
+ANN_INDEX_FILE = 'ann-index.npz'
+EXPORT_EMBEDDINGS = True # Switch for exporting vocabulary and embeddings after training
+EMBEDDINGS_FILE = 'embeddings.cbow' # memory mappable export, word2vec formats are written next to it
+QUANTIZATION = None # None, 'int8' or 'pq': build a quantised similarity index of the exported embeddings
+SIMILARITY_FILE = 'word-similarity.tsv' # word similarity suite, evaluated after training if the file exists
+ANALOGY_FILE = 'word-analogies.tsv' # analogy suite, evaluated after training if the file exists
 corpus_attributes = {'No_Of_Words': 0, 
                      'Stop_Words_Count': 0, 
                      'Punctuation_Count': 0,
                      'Number_Count': 0,
                      'NoW_After_CleanUp' :0,
-                     "Non_english_word_Count":0}
-
-
-"""
-Saves a checkpoint of the training to a file.
-This can be used to resume training or to reload a specific model state.
-
-IMPORTANT: 
-If you change context_size, dimensions, optimizers, ... you need to delete or rename the checkpoint, as the dimensions of the tensors wont match with the previous settings!
-"""
-def save_model(model, optimizer, current_epoch, checkpoint_file):
-  if DEBUG_PRINT and DETAILED_DEBUG_PRINT:
-    # Print model's state_dict
-    print("Model's state_dict:")
-    for param_tensor in model.state_dict():
-      print(param_tensor, "\t", model.state_dict()[param_tensor].size())
-    # Print optimizer's state_dict
-    print("Optimizer's state_dict:")
-    for var_name in optimizer.state_dict():
-      print(var_name, "\t", optimizer.state_dict()[var_name])
-  
-  checkpoint = {
-          #'model': CBOW(model.vocab_size, model.embedding_size, model.context_size),
-          'state_dict': model.state_dict(),
-          'optimizer' : optimizer.state_dict(),
-          'epoch': current_epoch + 1}
-  
-  torch.save(checkpoint, checkpoint_file)
+                     "Non_english_word_Count":0,
+                     'Rare_Words_Count': 0}
+
 
 # Loads a checkpoint file
 def load_checkpoint(filepath):
     checkpoint = torch.load(filepath)    
     return checkpoint
 
+# copies all tensors of a (nested) state dict to the cpu
+def state_to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: state_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return state
+
+class CHECKPOINT_MANAGER():
+    '''
+    Writes checkpoints from a background thread so training does not wait for the disk.
+    The training thread only copies the state dicts to the cpu, the writer thread saves
+    them to a temporary file and renames it, so a checkpoint file is never half written.
+    Every checkpoint is kept as <name>-epochN<ext>, the latest one is also available
+    under checkpoint_file and only the last keep_last epoch files are kept.
+    metadata (e.g. the vocabulary) is stored in every checkpoint.
+
+    IMPORTANT:
+    If you change context_size, dimensions, optimizers, ... you need to delete or rename the checkpoint, as the dimensions of the tensors wont match with the previous settings!
+    '''
+    def __init__(self, checkpoint_file, every_epochs=CHECKPOINT_EVERY_EPOCHS, every_seconds=CHECKPOINT_EVERY_SECONDS, keep_last=CHECKPOINT_KEEP_LAST, metadata=None):
+        self.checkpoint_file = checkpoint_file
+        self.metadata = metadata or {}
+        self.every_epochs = every_epochs
+        self.every_seconds = every_seconds
+        self.keep_last = keep_last
+        self.last_save_time = time.time()
+        # epoch files of earlier (resumed) runs count towards keep_last as well
+        self.epoch_files = self.existing_epoch_files()
+        self.snapshot_times = []
+        self.write_times = []
+        self.error = None
+        # at most two pending checkpoints, saving blocks if the disk cannot keep up
+        self.pending = queue.Queue(maxsize=2)
+        self.writer = threading.Thread(target=self.write_pending, daemon=True)
+        self.writer.start()
+
+    def existing_epoch_files(self):
+        '''
+        Returns the <name>-epochN<ext> files on disk, lowest epoch first
+        '''
+        root, ext = os.path.splitext(self.checkpoint_file)
+        directory, prefix = os.path.split(root + '-epoch')
+        epoch_files = []
+        for name in os.listdir(directory or '.'):
+            if not (name.startswith(prefix) and name.endswith(ext)):
+                continue
+            epoch = name[len(prefix):len(name) - len(ext)] if ext else name[len(prefix):]
+            if epoch.isdigit():
+                epoch_files.append((int(epoch), os.path.join(directory, name)))
+        return [filename for _, filename in sorted(epoch_files)]
+
+    def should_save(self, current_epoch):
+        if self.every_epochs and (current_epoch + 1) % self.every_epochs == 0:
+            return True
+        return self.every_seconds is not None and time.time() - self.last_save_time >= self.every_seconds
+
+    def save(self, model, optimizer, current_epoch, force=False):
+        '''
+        Queue a checkpoint if the policy asks for one (or force is set).
+        Returns True if a checkpoint was queued
+        '''
+        if self.error is not None:
+            raise self.error
+        if not (force or self.should_save(current_epoch)):
+            return False
+        if DEBUG_PRINT and DETAILED_DEBUG_PRINT:
+            # Print model's state_dict
+            print("Model's state_dict:")
+            for param_tensor, value in model.state_dict().items():
+                print(param_tensor, "\t", value.size())
+            # Print optimizer's state_dict
+            print("Optimizer's state_dict:")
+            for var_name, value in optimizer.state_dict().items():
+                print(var_name, "\t", value)
+        start_time = time.time()
+        checkpoint = {
+                'state_dict': state_to_cpu(model.state_dict()),
+                'optimizer' : state_to_cpu(optimizer.state_dict()),
+                'epoch': current_epoch + 1}
+        checkpoint.update(self.metadata)
+        self.snapshot_times.append(time.time() - start_time)
+        self.last_save_time = time.time()
+        self.pending.put(checkpoint)
+        return True
+
+    def write_atomic(self, checkpoint, filename):
+        temp_file = filename + '.tmp'
+        torch.save(checkpoint, temp_file)
+        os.replace(temp_file, filename)
+
+    def write_pending(self):
+        while True:
+            checkpoint = self.pending.get()
+            if checkpoint is None:
+                break
+            try:
+                start_time = time.time()
+                root, ext = os.path.splitext(self.checkpoint_file)
+                epoch_file = '{}-epoch{}{}'.format(root, checkpoint['epoch'], ext)
+                self.write_atomic(checkpoint, epoch_file)
+                # point the latest checkpoint at the new file, a hard link avoids writing it twice
+                temp_file = self.checkpoint_file + '.tmp'
+                try:
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+                    os.link(epoch_file, temp_file)
+                    os.replace(temp_file, self.checkpoint_file)
+                except OSError:
+                    self.write_atomic(checkpoint, self.checkpoint_file)
+                # the newest file is kept longest, even if an older run wrote a higher epoch
+                if epoch_file in self.epoch_files:
+                    self.epoch_files.remove(epoch_file)
+                self.epoch_files.append(epoch_file)
+                while len(self.epoch_files) > self.keep_last:
+                    os.remove(self.epoch_files.pop(0))
+                self.write_times.append(time.time() - start_time)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        '''
+        Wait for all queued checkpoints to be written and print the checkpoint latency
+        '''
+        self.pending.put(None)
+        self.writer.join()
+        if self.snapshot_times:
+            print("{} checkpoints, snapshot {:.1f} ms avg (training thread), write {:.1f} ms avg (background)".format(
+                len(self.snapshot_times), 1000 * np.mean(self.snapshot_times), 1000 * np.mean(self.write_times or [0])))
+        if self.error is not None:
+            raise self.error
+
 # Resets a model to a given checkpoint
 def reset_model_to_checkpoint(model, optimizer, checkpoint_file):
   print('loading checkpoint...\n')
@@ -106,31 +276,80 @@ def model_to_cuda(model):
 
 
 
-class CBOW(nn.Module):
-    def __init__(self, vocab_size, embedding_size, context_size):
-        super(CBOW, self).__init__()
-        self.vocab_size = vocab_size
-        self.embedding_size = embedding_size
-        self.context_size = context_size
-        self.embeddings = nn.Embedding(self.vocab_size, self.embedding_size)
-        # return vector size will be context_size*2*embedding_size
-        self.lin1 = nn.Linear(self.context_size * 2 * self.embedding_size, 50)
-        self.lin2 = nn.Linear(50, self.vocab_size)
-    
-    def forward(self, inp):
-        """
-        CBOW Structure:
-        2 Layers
-        1 Hidden Layer using ReLu
-        """
-        out = self.embeddings(inp).view(1, -1)
-        out = out.view(1, -1)
-        out = self.lin1(out)
-        out = F.relu(out)
-        out = self.lin2(out)
-        out = F.log_softmax(out, dim=1)
-        return out
-    
+def build_noise_table(word_counts, table_size=NOISE_TABLE_SIZE):
+    '''
+    Table of word indices in which every word occurs proportional to count^0.75,
+    uniform samples from the table are negative samples as in word2vec
+    '''
+    probabilities = np.asarray(word_counts, dtype=np.float64) ** 0.75
+    cumulative = np.cumsum(probabilities / probabilities.sum())
+    table = np.searchsorted(cumulative, (np.arange(table_size) + 0.5) / table_size)
+    return np.minimum(table, len(cumulative) - 1)
+
+def build_huffman_tree(word_counts):
+    '''
+    Huffman tree over the vocabulary, frequent words get short paths.
+    Returns for every word the inner nodes on the path from the root (points)
+    and the branch taken at each of them (codes)
+    '''
+    vocab_size = len(word_counts)
+    # ties are broken by node id to get the same tree on every run
+    heap = [(int(count), i) for i, count in enumerate(word_counts)]
+    heapq.heapify(heap)
+    parent = [0] * (2 * vocab_size - 1)
+    branch = [0] * (2 * vocab_size - 1)
+    next_node = vocab_size
+    while len(heap) > 1:
+        count_1, node_1 = heapq.heappop(heap)
+        count_2, node_2 = heapq.heappop(heap)
+        parent[node_1], branch[node_1] = next_node, 0
+        parent[node_2], branch[node_2] = next_node, 1
+        heapq.heappush(heap, (count_1 + count_2, next_node))
+        next_node += 1
+    root = next_node - 1
+
+    points, codes = [], []
+    for word in range(vocab_size):
+        path, code = [], []
+        node = word
+        while node != root:
+            # inner nodes are numbered from 0 for the node embedding
+            path.append(parent[node] - vocab_size)
+            code.append(branch[node])
+            node = parent[node]
+        points.append(path[::-1])
+        codes.append(code[::-1])
+    return points, codes
+
+def grow_parameter(parameter, num_rows, optimizer=None):
+    '''
+    Returns a copy of parameter grown to num_rows rows. New rows are drawn from a normal
+    distribution with the spread of the existing values. The optimizer is pointed to the
+    new parameter, its state is kept for the existing rows and zero for the new ones
+    '''
+    old = parameter.data
+    scale = old.std() if old.numel() > 1 else 1.0
+    new_rows = torch.randn((num_rows - len(old),) + tuple(old.shape[1:]), dtype=old.dtype, device=old.device) * scale
+    grown = nn.Parameter(torch.cat([old, new_rows]), requires_grad=parameter.requires_grad)
+    if optimizer is None:
+        return grown
+    optimizers = optimizer.optimizers if isinstance(optimizer, MULTI_OPTIMIZER) else [optimizer]
+    for sub_optimizer in optimizers:
+        for group in sub_optimizer.param_groups:
+            group['params'] = [grown if p is parameter else p for p in group['params']]
+        if parameter in sub_optimizer.state:
+            state = sub_optimizer.state.pop(parameter)
+            # moment estimates have the shape of the parameter, step counters are kept as they are
+            sub_optimizer.state[grown] = {key: torch.cat([value, value.new_zeros((num_rows - len(value),) + tuple(value.shape[1:]))])
+                                          if torch.is_tensor(value) and value.shape == old.shape else value
+                                          for key, value in state.items()}
+    return grown
+
+class EMBEDDING_MODEL(nn.Module):
+    '''
+    Word lookup and export shared by the CBOW and skip-gram models,
+    the word vectors are the rows of self.embeddings
+    '''
     def get_word_vector(self, word_idx):
         
         '''
@@ -146,93 +365,334 @@ class CBOW(nn.Module):
 
         return self.embeddings(word).view(1, -1)
     
+    def grow_vocabulary(self, vocab_size, word_counts, optimizer=None):
+        '''
+        Append rows for new words to every matrix indexed by the vocabulary, the rows
+        of the known words are kept (see grow_parameter). The optimizer is moved to the
+        grown parameters. word_counts of the new vocabulary rebuild the noise table
+        '''
+        if vocab_size < self.vocab_size:
+            raise ValueError('the vocabulary can only grow, {} < {} words'.format(vocab_size, self.vocab_size))
+        if self.output_layer == 'hierarchical_softmax':
+            raise ValueError('the Huffman tree of hierarchical softmax can not be extended, the model has to be retrained')
+        for name in ['embeddings', 'out_embeddings']:
+            module = getattr(self, name, None)
+            if module is not None:
+                module.weight = grow_parameter(module.weight, vocab_size, optimizer)
+                module.num_embeddings = vocab_size
+        lin2 = getattr(self, 'lin2', None)
+        if lin2 is not None:
+            lin2.weight = grow_parameter(lin2.weight, vocab_size, optimizer)
+            lin2.bias = grow_parameter(lin2.bias, vocab_size, optimizer)
+            lin2.out_features = vocab_size
+        if hasattr(self, 'noise_table'):
+            self.noise_table = torch.from_numpy(build_noise_table(word_counts)).to(self.noise_table.device)
+        self.vocab_size = vocab_size
+
     def write_embedding_to_file(self,filename):
-        for i in self.embeddings.parameters():
-            weights = i.data.numpy()
+        weights = self.embeddings.weight.detach().cpu().numpy()
         np.save(filename,weights)
+
+    def export_embeddings(self, filename, unique_vocab, dtype=np.float32, word2vec=True):
+        '''
+        Export vocabulary and embeddings to a single memory mappable file (see embedding_io),
+        optionally also in the word2vec text (.txt) and binary (.bin) format
+        '''
+        weights = self.embeddings.weight.detach().cpu().numpy()
+        write_embeddings(filename, weights, unique_vocab, dtype)
+        if word2vec:
+            root = os.path.splitext(filename)[0]
+            write_word2vec(root + '.txt', weights, unique_vocab)
+            write_word2vec(root + '.bin', weights, unique_vocab, binary=True)
+
+class CBOW(EMBEDDING_MODEL):
+    def __init__(self, vocab_size, embedding_size, context_size, output_layer='softmax', word_counts=None, negative_samples=NEGATIVE_SAMPLES, sparse=False):
+        '''
+        output_layer selects how the center word is predicted from the hidden layer
+        softmax: linear layer to the full vocabulary, O(vocab_size) per context
+        negative_sampling: the target against negative_samples noise words drawn from unigram^0.75
+        hierarchical_softmax: binary decisions along the Huffman tree path of the target, O(log vocab_size)
+        The last two need the corpus counts of each word (word_counts)
+        With sparse the embedding tables produce sparse gradients which only hold the rows used in a batch
+        '''
+        super(CBOW, self).__init__()
+        self.vocab_size = vocab_size
+        self.embedding_size = embedding_size
+        self.context_size = context_size
+        self.output_layer = output_layer
+        self.negative_samples = negative_samples
+        self.sparse = sparse
+        self.embeddings = nn.Embedding(self.vocab_size, self.embedding_size, sparse=sparse)
+        # return vector size will be context_size*2*embedding_size
+        self.lin1 = nn.Linear(self.context_size * 2 * self.embedding_size, HIDDEN_DIM)
+        if output_layer == 'softmax':
+            self.lin2 = nn.Linear(HIDDEN_DIM, self.vocab_size)
+        elif output_layer == 'negative_sampling':
+            self.out_embeddings = nn.Embedding(self.vocab_size, HIDDEN_DIM, sparse=sparse)
+            # the table is rebuilt from word_counts, no need to store it in checkpoints
+            self.register_buffer('noise_table', torch.from_numpy(build_noise_table(word_counts)), persistent=False)
+        elif output_layer == 'hierarchical_softmax':
+            points, codes = build_huffman_tree(word_counts)
+            depth = max(len(path) for path in points)
+            hs_points = torch.zeros(self.vocab_size, depth, dtype=torch.long)
+            hs_codes = torch.zeros(self.vocab_size, depth)
+            hs_mask = torch.zeros(self.vocab_size, depth)
+            for word, (path, code) in enumerate(zip(points, codes)):
+                hs_points[word, :len(path)] = torch.tensor(path, dtype=torch.long)
+                hs_codes[word, :len(code)] = torch.tensor(code, dtype=torch.float)
+                hs_mask[word, :len(path)] = 1
+            self.node_embeddings = nn.Embedding(self.vocab_size - 1, HIDDEN_DIM, sparse=sparse)
+            self.register_buffer('hs_points', hs_points, persistent=False)
+            self.register_buffer('hs_codes', hs_codes, persistent=False)
+            self.register_buffer('hs_mask', hs_mask, persistent=False)
+        else:
+            raise ValueError('unknown output layer {}'.format(output_layer))
+
+    def hidden(self, inp):
+        '''
+        Hidden layer activations for a single context or a batch of contexts
+        '''
+        if inp.dim() == 1:
+            inp = inp.unsqueeze(0)
+        out = self.embeddings(inp).view(inp.size(0), -1)
+        out = self.lin1(out)
+        return F.relu(out)
+    
+    def forward(self, inp):
+        """
+        CBOW Structure:
+        2 Layers
+        1 Hidden Layer using ReLu
+        inp is either a single context of shape (2*context_size) or
+        a batch of contexts of shape (batch, 2*context_size)
+        Returns the log probabilities of all words being the center word
+        """
+        out = self.hidden(inp)
+        if self.output_layer == 'softmax':
+            out = self.lin2(out)
+        elif self.output_layer == 'negative_sampling':
+            out = out @ self.out_embeddings.weight.t()
+        else:
+            # log probability of a word is the sum of the log probabilities of the branches on its path
+            node_scores = (out @ self.node_embeddings.weight.t())[:, self.hs_points]
+            signs = 2 * self.hs_codes - 1
+            return (F.logsigmoid(node_scores * signs) * self.hs_mask).sum(dim=2)
+        out = F.log_softmax(out, dim=1)
+        return out
+
+    def loss(self, inp, target, generator=None):
+        '''
+        Training loss of the contexts inp for the center words target, averaged over the batch.
+        Only the softmax output layer touches the whole vocabulary.
+        generator draws the negative samples, the default one if None
+        '''
+        if self.output_layer == 'softmax':
+            return F.nll_loss(self(inp), target)
+        hidden = self.hidden(inp)
+        if self.output_layer == 'negative_sampling':
+            samples = torch.randint(len(self.noise_table), (len(target), self.negative_samples), device=target.device, generator=generator)
+            noise = self.noise_table[samples]
+            positive = (hidden * self.out_embeddings(target)).sum(dim=1)
+            negative = torch.bmm(self.out_embeddings(noise), hidden.unsqueeze(2)).squeeze(2)
+            return -(F.logsigmoid(positive) + F.logsigmoid(-negative).sum(dim=1)).mean()
+        nodes = self.node_embeddings(self.hs_points[target])
+        node_scores = torch.bmm(nodes, hidden.unsqueeze(2)).squeeze(2)
+        signs = 2 * self.hs_codes[target] - 1
+        return -(F.logsigmoid(node_scores * signs) * self.hs_mask[target]).sum(dim=1).mean()
+
+class SKIPGRAM(EMBEDDING_MODEL):
+    def __init__(self, vocab_size, embedding_size, context_size, word_counts, negative_samples=NEGATIVE_SAMPLES, sparse=False):
+        '''
+        Skip-gram with negative sampling: the center word predicts each of its
+        2*context_size context words against negative_samples noise words per pair.
+        Trains on the same (contexts, center words) batches as CBOW
+        '''
+        super(SKIPGRAM, self).__init__()
+        self.vocab_size = vocab_size
+        self.embedding_size = embedding_size
+        self.context_size = context_size
+        self.output_layer = 'negative_sampling'
+        self.negative_samples = negative_samples
+        self.sparse = sparse
+        self.embeddings = nn.Embedding(self.vocab_size, self.embedding_size, sparse=sparse)
+        self.out_embeddings = nn.Embedding(self.vocab_size, self.embedding_size, sparse=sparse)
+        # word2vec initialisation, output vectors start at zero
+        nn.init.uniform_(self.embeddings.weight, -0.5 / embedding_size, 0.5 / embedding_size)
+        nn.init.zeros_(self.out_embeddings.weight)
+        self.register_buffer('noise_table', torch.from_numpy(build_noise_table(word_counts)), persistent=False)
+
+    def forward(self, center):
+        '''
+        Log probabilities of every word appearing in the context of the center words
+        '''
+        if center.dim() == 0:
+            center = center.unsqueeze(0)
+        return F.log_softmax(self.embeddings(center) @ self.out_embeddings.weight.t(), dim=1)
+
+    def loss(self, inp, target, generator=None):
+        '''
+        Negative sampling loss of all (center word, context word) pairs in the batch,
+        averaged over the center words. inp are the contexts, target the center words.
+        generator draws the negative samples, the default one if None
+        '''
+        if inp.dim() == 1:
+            inp = inp.unsqueeze(0)
+        center = self.embeddings(target).unsqueeze(2)
+        samples = torch.randint(len(self.noise_table), (len(target), inp.size(1) * self.negative_samples), device=target.device, generator=generator)
+        noise = self.noise_table[samples]
+        positive = torch.bmm(self.out_embeddings(inp), center).squeeze(2)
+        negative = torch.bmm(self.out_embeddings(noise), center).squeeze(2)
+        return -(F.logsigmoid(positive).sum(dim=1) + F.logsigmoid(-negative).sum(dim=1)).mean()
+
+def build_model(model_type, vocab_size, word_counts, context_size=CONTEXT_SIZE, output_layer=OUTPUT_LAYER, sparse=False):
+    '''
+    CBOW or skip-gram model for the vocabulary, skip-gram always uses negative sampling
+    '''
+    if model_type == 'cbow':
+        return CBOW(vocab_size, EMBEDDING_DIM, context_size, output_layer, word_counts, sparse=sparse)
+    if model_type == 'skipgram':
+        return SKIPGRAM(vocab_size, EMBEDDING_DIM, context_size, word_counts, sparse=sparse)
+    raise ValueError('unknown model type {}'.format(model_type))
     
+# corpus_attributes keys of the token categories, words of category 0 are kept
+TOKEN_CATEGORIES = [None, 'Punctuation_Count', 'Number_Count', 'Stop_Words_Count']
+
 class DATA_PREPROCESSOR():
     def __init__(self, file_path):
         self.file_path = file_path
+        self.stop_words = None
 
-    def readDataSet(self):
+    def readLines(self):
         '''
-        Read input corpus file 
+        Read the input corpus file line by line, only one line is held in memory
         '''
-        filename = self.file_path
-        print(filename)    
-        
-        with open(filename, 'r',encoding="utf8") as file:
-            corpus = file.read().replace('\t', '')
-        
-        return corpus
+        with open(self.file_path, 'r',encoding="utf8") as file:
+            for line in file:
+                yield line.replace('\t', '')
 
-    def removeStopWords(self, corpus):
+    def loadWordLists(self):
         '''
-        Remove Stop Words, Punctuations, Special Characters, Rare Words
-        Fill data structures for plotting the data distribution
-        Stop words list is taken from NLTK
+        Load stop words, punctuation and english dictionary used for the cleanup
+        Word lists are taken from NLTK and only loaded once
         '''
-        from nltk.corpus import stopwords 
-        from nltk.tokenize import word_tokenize 
-        from nltk.tokenize.treebank import TreebankWordDetokenizer
+        if self.stop_words is not None:
+            return
         nltk.download('words')
         nltk.download('stopwords')
         nltk.download('punkt')
-        stop_words = set(stopwords.words('english')) 
-        word_tokens = word_tokenize(corpus) 
-        filtered_sentence = [] 
-        stop_word_count = 0
-        punctuation_cnt = 0
-        digit_cnt = 0
-        punc = set(string.punctuation)
-        words = set(nltk.corpus.words.words())
-        nonEnglish=0
-        
-        for w in word_tokens: 
-            # Calculate non english words
-            if w.lower() not in words:
-                nonEnglish+=1
-            # Calculate Punctuation Count    
-            if w in punc:
-                punctuation_cnt += 1  
-            # Calculate Nuymeric Digits Count     
+        self.stop_words = set(stopwords.words('english')) 
+        self.punc = set(string.punctuation)
+        self.english_words = set(nltk.corpus.words.words())
+        # memo of token -> code, see tokenCode
+        self.token_codes = {}
+        for w in self.stop_words | self.punc:
+            self.tokenCode(w)
+
+    def tokenCode(self, w):
+        '''
+        Classify a token into 2 * category + non english flag, category indexes
+        TOKEN_CATEGORIES and codes below 2 are kept words.
+        Every distinct token is classified once, later lookups come from the memo
+        '''
+        code = self.token_codes.get(w)
+        if code is None:
+            if w in self.punc:
+                category = 1
             elif w.isnumeric():
-                digit_cnt += 1
-                
-            elif w not in stop_words: 
-                filtered_sentence.append(w)
-                
+                category = 2
+            elif w in self.stop_words:
+                category = 3
             else:
-                stop_word_count+= 1  
-        # Remove rare words
-        if REMOVE_RARE_WORDS:
-            fdist = FreqDist(filtered_sentence)
-            # Get list of words with frequency less than 5
-            rare_words = list(filter(lambda x: x[1]<=5,fdist.items()))
-            if DEBUG_PRINT:
-                print(rare_words)
-            for word in filtered_sentence:  
-                for entry in rare_words:
-                    if word in entry:
-                        filtered_sentence.remove(word)
-        
-        # Update internal data structure used in plotting         
-        corpus_attributes.update({"Stop_Words_Count":(stop_word_count)})
-        corpus_attributes.update({"Punctuation_Count":(punctuation_cnt)})
-        corpus_attributes.update({"No_Of_Words":(len(word_tokens))})   
-        corpus_attributes.update({"Number_Count": (digit_cnt)})
-        corpus_attributes.update({"Non_english_word_Count": (nonEnglish)})
+                category = 0
+            code = self.token_codes[w] = 2 * category + (w.lower() not in self.english_words)
+        return code
+
+    def filterWords(self, word_tokens, counts):
+        '''
+        Yield the tokens which are no stop words, punctuation or numbers
+        The category counts are accumulated in counts (keys of corpus_attributes).
+        Per token there is one memo lookup, the codes are tallied in a list
+        and only added to counts once per call
+        '''
+        token_codes = self.token_codes
+        tally = [0] * (2 * len(TOKEN_CATEGORIES))
+        kept = []
+        for w in word_tokens:
+            code = token_codes.get(w)
+            if code is None:
+                code = self.tokenCode(w)
+            tally[code] += 1
+            if code < 2:
+                kept.append(w)
+        for code, occurrences in enumerate(tally):
+            if occurrences:
+                counts['No_Of_Words'] += occurrences
+                if code & 1:
+                    counts['Non_english_word_Count'] += occurrences
+                if code >= 2:
+                    counts[TOKEN_CATEGORIES[code // 2]] += occurrences
+        yield from kept
+
+    def updateCorpusAttributes(self, counts):
+        '''
+        Copy the word category counts into corpus_attributes used in plotting
+        '''
+        for key in ['Stop_Words_Count', 'Punctuation_Count', 'No_Of_Words', 'Number_Count', 'Non_english_word_Count']:
+            corpus_attributes.update({key: counts[key]})
         if DEBUG_PRINT:
-            print('stop_word_count', stop_word_count)
-            print('punctuation_cnt', punctuation_cnt)
-            print('No_Of_Words', (len(word_tokens)))
-            print('Number_Count', digit_cnt)
-            print('Non_english_word_Count', nonEnglish)
-        return TreebankWordDetokenizer().detokenize(filtered_sentence)
+            print('stop_word_count', counts['Stop_Words_Count'])
+            print('punctuation_cnt', counts['Punctuation_Count'])
+            print('No_Of_Words', counts['No_Of_Words'])
+            print('Number_Count', counts['Number_Count'])
+            print('Non_english_word_Count', counts['Non_english_word_Count'])
+
+    def cleanLine(self, line, counts):
+        '''
+        Lowercase and tokenize a single line, yields the words kept by filterWords
+        '''
+        line = line.strip().lower()
+        if line:
+            yield from self.filterWords(word_tokenize(line), counts)
+
+    def streamWords(self):
+        '''
+        Generator over the lowercased words of the corpus which survive stop word,
+        punctuation and number removal. The file is tokenized line by line
+        '''
+        self.loadWordLists()
+        counts = Counter()
+        for line in self.readLines():
+            yield from self.cleanLine(line, counts)
+        self.updateCorpusAttributes(counts)
+
+    def stripPunctuation(self, words):
+        '''
+        Remove punctuation inside the words and yield the remaining tokens
+        '''
+        punctuation_table = str.maketrans('', '', string.punctuation)
+        for word in words:
+            for token in word.translate(punctuation_table).split():
+                if '’' not in token:
+                    yield token
+
+    def lineShards(self, num_shards):
+        '''
+        Split the corpus file into at most num_shards ranges of whole lines.
+        Returns the (start, end) byte offsets of each range in file order
+        '''
+        size = os.path.getsize(self.file_path)
+        offsets = [0]
+        with open(self.file_path, 'rb') as file:
+            for k in range(1, num_shards):
+                file.seek(max(size * k // num_shards, offsets[-1]))
+                # move on to the start of the next line
+                file.readline()
+                offsets.append(file.tell())
+        offsets.append(size)
+        return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
     # add abbreviations won't don't etc..
 
-    def preprocess_data(self):
+    def preprocess_data(self, num_workers=NUM_WORKERS):
         '''
         Preprocess the input corpus. Following steps are involed in data cleaning
         a) Make all words lowercase
@@ -240,70 +700,406 @@ class DATA_PREPROCESSOR():
         c) Remove numeric digits
         d) Remove puntuation and special characters
         e) Remove rare words. 
+        Every line is cleaned by cleanLine, with more than one worker in a process pool
+        (see preprocess_parallel). The number of workers only changes the speed, not the result.
+        Returns the int32 tokens and the vocabulary (see encodeWords)
         '''
-        corpus = self.readDataSet()
-    
-        # remove additional spaces
-        corpus = corpus.strip()
-    
-        # make everything lowercase
-        corpus = corpus.lower()
-      
-        #remove stop words
-        corpus = self.removeStopWords(corpus)
-     
-        # remove puntuations
-        corpus = corpus.translate(str.maketrans('', '', string.punctuation))
-        #clean_data = corpus
-        corpus = corpus.split()
-    
-        for i,x in enumerate(corpus):
-            if '’' in x:
-                del corpus[i]
-                
+        if num_workers > 1:
+            return self.preprocess_parallel(num_workers)
+        return self.preprocess_stream()
+
+    def encodeWords(self, words, min_count=MIN_WORD_COUNT):
+        '''
+        Rare word removal and punctuation stripping of the words kept by filterWords.
+        The words are encoded into an int32 array while they are produced, rare words
+        are removed with a mask over the word counts and the punctuation is stripped
+        once per distinct word instead of once per token.
+        Returns the int32 tokens and the vocabulary in order of first occurrence,
+        the same encoding as CONTEXT_DATASET.from_corpus
+        '''
+        word_to_idx = {}
+        ids = np.fromiter((word_to_idx.setdefault(w, len(word_to_idx)) for w in words), dtype=np.int32)
+        words = list(word_to_idx)
+        keep = np.ones(len(words), dtype=bool)
+        if REMOVE_RARE_WORDS:
+            counts = np.bincount(ids, minlength=len(words))
+            keep = counts >= min_count
+            if DEBUG_PRINT:
+                print([word for word, kept in zip(words, keep) if not kept])
+            dropped = int(counts[~keep].sum())
+            corpus_attributes.update({"Rare_Words_Count": (dropped)})
+            print('Removed {} rare word tokens ({} distinct words with count < {})'.format(dropped, int((~keep).sum()), min_count))
+
+        # remove puntuations, a word becomes zero or more tokens
+        token_to_idx = {}
+        pieces = [[token_to_idx.setdefault(token, len(token_to_idx)) for token in self.stripPunctuation([word])] if kept else []
+                  for word, kept in zip(words, keep)]
+        lengths = np.array([len(piece) for piece in pieces], dtype=np.int64)
+        flat_pieces = np.array([token for piece in pieces for token in piece], dtype=np.int32)
+        piece_starts = np.cumsum(lengths) - lengths
+        token_lengths = lengths[ids]
+        # position of every output token in flat_pieces
+        offsets = np.arange(token_lengths.sum()) - np.repeat(np.cumsum(token_lengths) - token_lengths, token_lengths)
+        tokens = flat_pieces[np.repeat(piece_starts[ids], token_lengths) + offsets]
+
+        # number the tokens in order of first occurrence
+        unique_tokens, first_positions = np.unique(tokens, return_index=True)
+        unique_tokens = unique_tokens[np.argsort(first_positions)]
+        renumber = np.zeros(len(token_to_idx), dtype=np.int32)
+        renumber[unique_tokens] = np.arange(len(unique_tokens), dtype=np.int32)
+        token_vocab = list(token_to_idx)
+        unique_vocab = [token_vocab[token] for token in unique_tokens]
+        tokens = renumber[tokens]
+
         if DEBUG_PRINT:
-            print('Corpus Size After CleanUp',len(corpus))    
-        corpus_attributes.update({"NoW_After_CleanUp":(len(corpus))})
-   
-        return corpus
-    
-        print(len(data))
+            print('Corpus Size After CleanUp',len(tokens))
+        corpus_attributes.update({"NoW_After_CleanUp":(len(tokens))})
+        return tokens, unique_vocab
+
+    def preprocess_stream(self):
+        '''
+        Single process preprocess_data, the corpus is read and cleaned line by line
+        in a single pass without ever holding the whole corpus text or word list in memory.
+        Returns the int32 tokens and the vocabulary (see encodeWords)
+        '''
+        return self.encodeWords(self.streamWords())
+
+    def preprocess_parallel(self, num_workers=NUM_WORKERS):
+        '''
+        Process pool variant of preprocess_data. The corpus file is split into
+        line ranges which are cleaned by num_workers processes (preprocess_shard).
+        Results are merged in file order, so the tokens and corpus_attributes
+        do not depend on the scheduling of the workers.
+        Returns the int32 tokens and the vocabulary (see encodeWords)
+        '''
+        # a few shards per worker so that uneven shards do not leave workers idle
+        shards = [(self.file_path, start, end) for start, end in self.lineShards(4 * num_workers)]
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.map(preprocess_shard, shards)
+
+        words = []
+        counts = Counter()
+        for shard_words, shard_counts in results:
+            words.extend(shard_words)
+            counts.update(shard_counts)
+        self.updateCorpusAttributes(counts)
+        return self.encodeWords(words)
+
+def preprocess_shard(shard):
+    '''
+    Worker function of DATA_PREPROCESSOR.preprocess_parallel.
+    shard is (file_path, start, end), the lines in this byte range are cleaned.
+    Returns the filtered words and the word category counts of the shard
+    '''
+    file_path, start, end = shard
+    preprocessor = DATA_PREPROCESSOR(file_path)
+    preprocessor.loadWordLists()
+    words = []
+    counts = Counter()
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        while file.tell() < end:
+            line = file.readline().decode('utf8').replace('\t', '')
+            words.extend(preprocessor.cleanLine(line, counts))
+    return words, counts
+
+# peak resident memory of this process in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class TRAINING_PROFILER():
+    '''
+    Measures the time of each phase of the training steps (data encoding, forward,
+    backward, optimizer step, checkpoint I/O) and aggregates it per epoch together
+    with samples/sec and peak RSS. One epoch can also be recorded with torch.profiler.
+    With synchronize the cuda queue is drained around every phase, otherwise
+    asynchronous gpu work is counted in whichever phase waits for it
+    '''
+    PHASES = ['data', 'forward', 'backward', 'optimizer', 'checkpoint']
+
+    def __init__(self, profile_epoch=PROFILE_EPOCH, synchronize=cuda_available):
+        self.profile_epoch = profile_epoch
+        self.synchronize = synchronize
+        self.torch_profiler = None
+        self.rows = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        yield
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self.phase_times[name] += time.perf_counter() - start
+
+    def start_epoch(self, epoch):
+        self.phase_times = dict.fromkeys(self.PHASES, 0.0)
+        self.epoch_start = time.perf_counter()
+        if epoch == self.profile_epoch:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if cuda_available:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities)
+            self.torch_profiler.start()
+
+    def end_epoch(self, epoch, num_samples, loss, **columns):
+        '''
+        Close the epoch and return its log row, columns are added to the row as they are
+        '''
+        seconds = time.perf_counter() - self.epoch_start
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            print(self.torch_profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+            self.torch_profiler.export_chrome_trace('profile-epoch{}.json'.format(epoch))
+            self.torch_profiler = None
+        row = {'epoch': epoch, 'samples': num_samples, 'loss': loss, 'seconds': seconds,
+               'samples_per_sec': num_samples / seconds if seconds > 0 else 0.0}
+        for name in self.PHASES:
+            row[name + '_seconds'] = self.phase_times[name]
+        row['peak_rss_mb'] = peak_rss_mb()
+        row.update(columns)
+        self.rows.append(row)
+        return row
+
+    def write(self, filename):
+        '''
+        Write the epoch rows as json (.json) or csv (any other extension)
+        '''
+        with open(filename, 'w', newline='') as file:
+            if filename.endswith('.json'):
+                json.dump(self.rows, file, indent=2)
+            elif self.rows:
+                writer = csv.DictWriter(file, fieldnames=list(self.rows[0]))
+                writer.writeheader()
+                writer.writerows(self.rows)
 
 class MODEL_EXECUTOR():
-    def __init__(self, model):
+    def __init__(self, model, base_word_counts=None):
+        '''
+        base_word_counts are the word counts of earlier corpora the model was trained on,
+        checkpoints store them added to the counts of the current dataset
+        '''
         self.model = model
+        self.base_word_counts = base_word_counts
+
+    def checkpoint_metadata(self, dataset):
+        '''
+        Vocabulary and total word counts stored with every checkpoint, they allow to
+        continue training on new text (see train_incremental)
+        '''
+        word_counts = dataset.word_counts().astype(np.int64)
+        if self.base_word_counts is not None:
+            word_counts[:len(self.base_word_counts)] += self.base_word_counts
+        return {'vocab': dataset.unique_vocab, 'word_counts': torch.from_numpy(word_counts)}
     
-    def train(self, optimizer, data, unique_vocab, word_to_idx, current_epoch, checkpoint_file):
+    def train(self, optimizer, data, unique_vocab, word_to_idx, current_epoch, checkpoint_file, dataset=None):
         '''
         Train the model. Training parameters will come from self class
         Epoch is defined as a macro
+        dataset is the CONTEXT_DATASET data was created from, its vocabulary and word
+        counts are stored in the checkpoints. Without it only unique_vocab is stored
         '''
-        nll_loss = nn.NLLLoss()  # loss function
         print(len(data))
         print('Starting training...\n')
-        for epoch in range(current_epoch, EPOCH):
-            total_loss = 0
-            for context, target in data:           
-                # use cuda support if available and send the model and tensors to the correct device
-                self.model = model_to_cuda(self.model)
-                inp_var = tensor_to_cuda(Variable(torch.LongTensor([word_to_idx[word] for word in context])))
-                target_var = tensor_to_cuda(Variable(torch.LongTensor([word_to_idx[target]])))
-
-                # set grad to zero for each context
-                self.model.zero_grad()
-                # calculate loss
-                log_prob = self.model(inp_var)
-                loss = nll_loss(log_prob, target_var)
-                # execute backward pass
-                loss.backward()
-                optimizer.step()
-                total_loss += loss.data
+        metadata = self.checkpoint_metadata(dataset) if dataset is not None else {'vocab': unique_vocab}
+        checkpoints = CHECKPOINT_MANAGER(checkpoint_file, metadata=metadata)
+        try:
+            for epoch in range(current_epoch, EPOCH):
+                total_loss = 0
+                epoch_start = time.time()
+                for context, target in data:           
+                    # use cuda support if available and send the model and tensors to the correct device
+                    self.model = model_to_cuda(self.model)
+                    inp_var = tensor_to_cuda(Variable(torch.LongTensor([word_to_idx[word] for word in context])))
+                    target_var = tensor_to_cuda(Variable(torch.LongTensor([word_to_idx[target]])))
+
+                    # set grad to zero for each context
+                    self.model.zero_grad()
+                    # calculate loss
+                    loss = self.model.loss(inp_var, target_var)
+                    # execute backward pass
+                    loss.backward()
+                    optimizer.step()
+                    total_loss += loss.data
             
-            if epoch % VERVOSE == 0:
-                loss_avg = float(total_loss / len(data))
-                print("{}/{} loss {:.2f}".format(epoch, EPOCH, loss_avg))
-            # save current checkpoint
-            save_model(self.model, optimizer,epoch, checkpoint_file)
+                epoch_time = time.time() - epoch_start
+                if epoch % VERVOSE == 0:
+                    loss_avg = float(total_loss / len(data))
+                    print("{}/{} loss {:.2f} ({:.0f} samples/sec)".format(epoch, EPOCH, loss_avg, len(data) / epoch_time))
+                # save current checkpoint, the last epoch is always saved
+                checkpoints.save(self.model, optimizer, epoch, force=(epoch == EPOCH - 1))
+        finally:
+            # queued checkpoints are written even if training fails or is interrupted
+            checkpoints.close()
+        return self.model
+
+    def validation_loss(self, dataset, indices, batch_size=VALIDATION_BATCH_SIZE):
+        '''
+        Mean loss over the given windows, computed in large batches without autograd.
+        Negative samples are drawn from a generator seeded with VALIDATION_SEED on every call,
+        otherwise the noise of the draws hides loss changes smaller than EARLY_STOPPING_MIN_DELTA
+        '''
+        total_loss = 0.0
+        device = next(self.model.parameters()).device
+        generator = torch.Generator(device=device).manual_seed(VALIDATION_SEED)
+        with torch.no_grad():
+            for start in range(0, len(indices), batch_size):
+                contexts, targets = dataset.get_batch(indices[start:start + batch_size])
+                loss = self.model.loss(tensor_to_cuda(torch.from_numpy(contexts)), tensor_to_cuda(torch.from_numpy(targets)), generator=generator)
+                total_loss += float(loss) * len(contexts)
+        return total_loss / max(len(indices), 1)
+
+    def train_batched(self, optimizer, dataset, current_epoch, checkpoint_file, batch_size=BATCH_SIZE, subsample_threshold=None, log_file=TRAINING_LOG_FILE,
+                      lr_schedule=LR_SCHEDULE, validation_fraction=VALIDATION_FRACTION, patience=EARLY_STOPPING_PATIENCE, end_epoch=EPOCH,
+                      lr_schedule_start=0):
+        '''
+        Train the model on shuffled mini-batches instead of single contexts.
+        dataset is a CONTEXT_DATASET, batches are gathered from its encoded
+        token windows so no word lookups happen inside the loop.
+        With a subsample_threshold a new random subset of windows is drawn every
+        epoch, windows centred on frequent words are dropped more often.
+        The learning rate follows lr_schedule (see LR_SCHEDULER), decaying from epoch
+        lr_schedule_start to end_epoch. A validation_fraction
+        of the windows is held out, training stops early once its loss did not improve
+        for patience epochs.
+        The time of every training phase is written to log_file (see TRAINING_PROFILER).
+        Training runs from current_epoch up to end_epoch
+        '''
+        self.model = model_to_cuda(self.model)
+        print(len(dataset))
+        print('Starting batched training (batch size {})...\n'.format(batch_size))
+        checkpoints = CHECKPOINT_MANAGER(checkpoint_file, metadata=self.checkpoint_metadata(dataset))
+        self.profiler = TRAINING_PROFILER()
+        scheduler = LR_SCHEDULER(optimizer, lr_schedule, end_epoch, start_epoch=lr_schedule_start)
+        train_indices, validation_indices = dataset.split_validation(validation_fraction)
+        stopper = EARLY_STOPPING(patience) if len(validation_indices) and patience is not None else None
+        training_windows = np.zeros(len(dataset), dtype=bool)
+        training_windows[train_indices] = True
+        dropped_windows = 0
+        try:
+            for epoch in range(current_epoch, end_epoch):
+                total_loss = 0
+                self.profiler.start_epoch(epoch)
+                epoch_start = time.time()
+                if subsample_threshold is not None:
+                    samples = dataset.subsample(subsample_threshold)
+                    samples = samples[training_windows[samples]]
+                    dropped_windows += len(train_indices) - len(samples)
+                else:
+                    samples = train_indices
+                num_samples = len(samples)
+                # new sample order for every epoch
+                permutation = samples[np.random.permutation(num_samples)]
+                for start in range(0, num_samples, batch_size):
+                    batch = permutation[start:start + batch_size]
+                    scheduler.set_progress(epoch + start / float(num_samples))
+                    with self.profiler.phase('data'):
+                        contexts, targets = dataset.get_batch(batch)
+                        inp_var = tensor_to_cuda(torch.from_numpy(contexts))
+                        target_var = tensor_to_cuda(torch.from_numpy(targets))
+
+                    with self.profiler.phase('forward'):
+                        self.model.zero_grad()
+                        loss = self.model.loss(inp_var, target_var)
+                    with self.profiler.phase('backward'):
+                        loss.backward()
+                    with self.profiler.phase('optimizer'):
+                        optimizer.step()
+                    # the loss is averaged over the batch, weight it back to a per-sample sum
+                    total_loss += loss.detach() * len(batch)
+
+                epoch_time = time.time() - epoch_start
+                loss_avg = float(total_loss / max(num_samples, 1))
+                validation_loss = self.validation_loss(dataset, validation_indices) if len(validation_indices) else None
+                stop = stopper is not None and stopper.update(validation_loss)
+                if epoch % VERVOSE == 0 or stop:
+                    print("{}/{} loss {:.2f} ({:.0f} samples/sec)".format(epoch, end_epoch, loss_avg, num_samples / epoch_time))
+                    if validation_loss is not None:
+                        print("validation loss {:.4f}, learning rate {:.2e}".format(validation_loss, scheduler.learning_rate()))
+                    if subsample_threshold is not None:
+                        print("subsampling kept {} of {} windows".format(num_samples, len(train_indices)))
+                # save current checkpoint, the last epoch is always saved
+                with self.profiler.phase('checkpoint'):
+                    checkpoints.save(self.model, optimizer, epoch, force=(epoch == end_epoch - 1 or stop))
+                self.profiler.end_epoch(epoch, num_samples, loss_avg, validation_loss=validation_loss, learning_rate=scheduler.learning_rate())
+                if stop:
+                    print("early stopping after epoch {}: validation loss did not improve for {} epochs (best {:.4f} in epoch {})".format(
+                        epoch, patience, stopper.best_loss, current_epoch + stopper.best_epoch))
+                    break
+        finally:
+            # queued checkpoints are written even if training fails or is interrupted
+            checkpoints.close()
+        if log_file:
+            self.profiler.write(log_file)
+        trained_epochs = len(self.profiler.rows)
+        if subsample_threshold is not None and trained_epochs:
+            # epoch time is proportional to the number of windows trained on
+            total_windows = len(train_indices) * trained_epochs
+            print("subsampling dropped {} of {} windows ({:.1%}), about {:.2f}x faster epochs".format(
+                dropped_windows, total_windows, dropped_windows / total_windows, total_windows / max(total_windows - dropped_windows, 1)))
+        return self.model
+
+    def train_hogwild(self, optimizer, dataset, current_epoch, checkpoint_file, num_processes=NUM_TRAINING_PROCESSES, batch_size=BATCH_SIZE):
+        '''
+        Hogwild training on the CPU. The model parameters are moved to shared memory
+        and num_processes workers (hogwild_worker) train on disjoint shards of the
+        dataset windows, each with its own SGD optimizer and without any locking.
+        optimizer only provides the learning rate and is stored in the checkpoints.
+        Without checkpoint_file no checkpoints are written
+        '''
+        self.model = self.model.cpu()
+        self.model.share_memory()
+        learning_rate = optimizer.param_groups[0]['lr']
+        # the encoded corpus is shared as well, workers only receive a handle.
+        # the tokens may be a read-only memmap of the preprocessing cache, share_memory_ copies them anyway
+        tokens = torch.from_numpy(np.array(dataset.tokens)).share_memory_()
+        # more processes than windows would leave some shards empty
+        shards = [shard for shard in np.array_split(np.arange(len(dataset)), num_processes) if len(shard)]
+        print(len(dataset))
+        print('Starting hogwild training ({} processes, batch size {})...\n'.format(num_processes, batch_size))
+        checkpoints = CHECKPOINT_MANAGER(checkpoint_file, metadata=self.checkpoint_metadata(dataset)) if checkpoint_file else None
+
+        context = torch.multiprocessing.get_context('spawn')
+        results = context.Queue()
+        processes = []
+        for rank, shard in enumerate(shards):
+            process = context.Process(target=hogwild_worker, args=(rank, self.model, tokens, dataset.context_size,
+                (shard[0], shard[-1] + 1), current_epoch, EPOCH, batch_size, learning_rate, results))
+            process.start()
+            processes.append(process)
+
+        self.contexts_per_second = []
+        epoch_reports = {}
+        try:
+            for _ in range((EPOCH - current_epoch) * len(processes)):
+                epoch, loss_sum, num_samples, seconds = wait_for_report(results, processes)
+                epoch_reports.setdefault(epoch, []).append((loss_sum, num_samples, seconds))
+                if len(epoch_reports[epoch]) < len(processes):
+                    continue
+                # every worker finished this epoch
+                reports = epoch_reports.pop(epoch)
+                total_samples = sum(report[1] for report in reports)
+                contexts_per_second = total_samples / max(report[2] for report in reports)
+                self.contexts_per_second.append(contexts_per_second)
+                if epoch % VERVOSE == 0:
+                    loss_avg = sum(report[0] for report in reports) / total_samples
+                    print("{}/{} loss {:.2f} ({:.0f} contexts/sec)".format(epoch, EPOCH, loss_avg, contexts_per_second))
+                if checkpoints is not None:
+                    checkpoints.save(self.model, optimizer, epoch, force=(epoch == EPOCH - 1))
+            for process in processes:
+                process.join()
+        finally:
+            # a failed worker or an interrupt stops the remaining workers
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            if checkpoints is not None:
+                checkpoints.close()
         return self.model
 
     def test(self, unique_vocab, word_to_idx):
@@ -334,7 +1130,8 @@ def plot (corpus):
     plt.bar(range(len(corpus_attributes)),values,tick_label=names)
     plt.show()
 
-    fdist = FreqDist(corpus)
+    # corpus is either the list of words or an already computed FreqDist
+    fdist = corpus if isinstance(corpus, FreqDist) else FreqDist(corpus)
     plt.figure(figsize=(10, 5))
 
     fdist.plot(50,cumulative=False,title='Most frequent Words', linewidth=2)
@@ -366,54 +1163,637 @@ def create_context(corpus_text):
     word_to_idx = {w: i for i, w in enumerate(unique_vocab)}
     return data,  unique_vocab, word_to_idx 
 
-def print_closest_word(cbow, word, word_to_idx,unique_vocab):
-    closest_word = get_closest_word(cbow, word, word_to_idx, unique_vocab)
+class MULTI_OPTIMIZER():
+    '''
+    Several optimizers over disjoint parameter sets that are used like one optimizer,
+    e.g. SparseAdam for the embedding tables and Adam for the linear layers
+    '''
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return {'optimizers': [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict['optimizers']):
+            optimizer.load_state_dict(state)
+
+def build_optimizer(model, use_adam=USE_ADAM, learning_rate=0.001):
+    '''
+    Optimizer for a CBOW model. Adam does not accept sparse gradients, so a model with
+    sparse embeddings gets SparseAdam for the embedding tables and Adam for the rest.
+    SGD handles sparse and dense gradients itself
+    '''
+    if not use_adam:
+        print('Using SGD as optimizer')
+        return torch.optim.SGD(model.parameters(), lr=learning_rate)
+    print('Using adam as optimizer')
+    if not model.sparse:
+        return torch.optim.Adam(model.parameters(), lr=learning_rate)
+    sparse_parameters = [p for m in model.modules() if isinstance(m, nn.Embedding) for p in m.parameters()]
+    sparse_ids = {id(p) for p in sparse_parameters}
+    dense_parameters = [p for p in model.parameters() if id(p) not in sparse_ids]
+    optimizers = [torch.optim.SparseAdam(sparse_parameters, lr=learning_rate)]
+    # skip-gram has no dense parameters
+    if dense_parameters:
+        optimizers.append(torch.optim.Adam(dense_parameters, lr=learning_rate))
+    return MULTI_OPTIMIZER(optimizers)
+
+class LR_SCHEDULER():
+    '''
+    Decays the learning rate of all parameter groups with the training progress,
+    progress is measured in epochs so it does not depend on the number of batches
+    which changes with subsampling. 'linear' decays like word2vec, 'cosine' follows
+    half a cosine, None keeps the learning rate constant.
+    The decay runs from start_epoch to epochs, a resumed run keeps start_epoch 0
+    and continues the decay, incremental training starts a new one
+    '''
+    def __init__(self, optimizer, schedule=LR_SCHEDULE, epochs=EPOCH, min_factor=MIN_LR_FACTOR, start_epoch=0):
+        if schedule not in (None, 'linear', 'cosine'):
+            raise ValueError('unknown learning rate schedule {}'.format(schedule))
+        self.optimizer = optimizer
+        self.schedule = schedule
+        self.epochs = epochs
+        self.start_epoch = start_epoch
+        self.min_factor = min_factor
+        self.base_lrs = [group.get('initial_lr', group['lr']) for group in optimizer.param_groups]
+        for group, base_lr in zip(optimizer.param_groups, self.base_lrs):
+            # kept in the optimizer state so a resumed run decays from the same initial rate
+            group['initial_lr'] = base_lr
+
+    def factor(self, progress):
+        fraction = min((progress - self.start_epoch) / float(max(self.epochs - self.start_epoch, 1)), 1.0)
+        if self.schedule == 'linear':
+            factor = 1.0 - fraction
+        elif self.schedule == 'cosine':
+            factor = 0.5 * (1.0 + math.cos(math.pi * fraction))
+        else:
+            return 1.0
+        return max(factor, self.min_factor)
+
+    def set_progress(self, progress):
+        if self.schedule is None:
+            return
+        factor = self.factor(progress)
+        for group, base_lr in zip(self.optimizer.param_groups, self.base_lrs):
+            group['lr'] = base_lr * factor
+
+    def learning_rate(self):
+        return self.optimizer.param_groups[0]['lr']
+
+class EARLY_STOPPING():
+    '''
+    Tracks the validation loss and tells when it has not improved by more than
+    min_delta for patience epochs
+    '''
+    def __init__(self, patience=EARLY_STOPPING_PATIENCE, min_delta=EARLY_STOPPING_MIN_DELTA):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = float('inf')
+        self.best_epoch = -1
+        self.epochs = 0
+
+    def update(self, loss):
+        '''
+        Record the loss of the next epoch, returns True if training should stop
+        '''
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.best_epoch = self.epochs
+        self.epochs += 1
+        return self.epochs - 1 - self.best_epoch >= self.patience
+
+# memory held by a dense or sparse tensor in bytes
+def tensor_bytes(tensor):
+    if tensor.is_sparse:
+        return tensor._values().numel() * tensor._values().element_size() + tensor._indices().numel() * tensor._indices().element_size()
+    return tensor.numel() * tensor.element_size()
+
+def benchmark_sparse_gradients(dataset, word_counts, steps=200, batch_size=BATCH_SIZE, use_adam=USE_ADAM):
+    '''
+    Train the same number of batches with dense and with sparse embedding gradients
+    and print the time per step and the memory of the gradients and optimizer state
+    '''
+    results = []
+    for sparse in [False, True]:
+        model = model_to_cuda(CBOW(len(dataset.unique_vocab), EMBEDDING_DIM, dataset.context_size, OUTPUT_LAYER, word_counts, sparse=sparse))
+        optimizer = build_optimizer(model, use_adam)
+        batches = np.random.randint(len(dataset), size=(steps, batch_size))
+        start_time = time.time()
+        for batch in batches:
+            contexts, targets = dataset.get_batch(batch)
+            optimizer.zero_grad()
+            loss = model.loss(tensor_to_cuda(torch.from_numpy(contexts)), tensor_to_cuda(torch.from_numpy(targets)))
+            loss.backward()
+            optimizer.step()
+        step_time = (time.time() - start_time) / steps
+        gradient_bytes = sum(tensor_bytes(p.grad) for p in model.parameters() if p.grad is not None)
+        optimizers = optimizer.optimizers if isinstance(optimizer, MULTI_OPTIMIZER) else [optimizer]
+        state_bytes = sum(tensor_bytes(value) for o in optimizers for state in o.state.values()
+                          for value in state.values() if torch.is_tensor(value))
+        results.append((sparse, step_time, gradient_bytes, state_bytes))
+    print('gradients  ms/step  gradient MB  optimizer state MB')
+    for sparse, step_time, gradient_bytes, state_bytes in results:
+        print('{:9s}  {:7.3f}  {:11.3f}  {:18.3f}'.format('sparse' if sparse else 'dense', 1000 * step_time, gradient_bytes / 2**20, state_bytes / 2**20))
+    return results
+
+def benchmark_token_classifier(corpus_file=CORPUS_FILE, repeats=3):
+    '''
+    Compare the memoised token classification of DATA_PREPROCESSOR.filterWords
+    with classifying every token separately (the previous filterWords). Both must give the same words and counts
+    '''
+    preprocessor = DATA_PREPROCESSOR(corpus_file)
+    preprocessor.loadWordLists()
+    lines = [word_tokenize(line.strip().lower()) for line in preprocessor.readLines() if line.strip()]
+
+    def per_token(word_tokens, counts):
+        for w in word_tokens:
+            counts['No_Of_Words'] += 1
+            if w.lower() not in preprocessor.english_words:
+                counts['Non_english_word_Count'] += 1
+            if w in preprocessor.punc:
+                counts['Punctuation_Count'] += 1
+            elif w.isnumeric():
+                counts['Number_Count'] += 1
+            elif w not in preprocessor.stop_words:
+                yield w
+            else:
+                counts['Stop_Words_Count'] += 1
+
+    results = {}
+    for name, classify in [('per token', per_token), ('memoised', preprocessor.filterWords)]:
+        best_time = float('inf')
+        for _ in range(repeats):
+            counts = Counter()
+            start_time = time.perf_counter()
+            words = [w for tokens in lines for w in classify(tokens, counts)]
+            best_time = min(best_time, time.perf_counter() - start_time)
+        results[name] = (best_time, words, counts)
+        print('{:9s} {:8.1f} ms for {} tokens'.format(name, 1000 * best_time, counts['No_Of_Words']))
+    (reference_time, reference_words, reference_counts), (memo_time, memo_words, memo_counts) = results.values()
+    if reference_words != memo_words or reference_counts != memo_counts:
+        raise AssertionError('memoised token classification differs from the per token classification')
+    print('identical results, {:.2f}x faster'.format(reference_time / memo_time))
+    return results
+
+def compare_models(dataset, word_counts, epochs=5, batch_size=BATCH_SIZE, learning_rate=0.001, probe_words=5):
+    '''
+    Train CBOW and skip-gram with negative sampling on the same context windows and
+    print their throughput, the evaluation suites (if available) and the closest
+    words of a few frequent words side by side
+    '''
+    results = {}
+    for model_type in ['cbow', 'skipgram']:
+        model = model_to_cuda(build_model(model_type, len(dataset.unique_vocab), word_counts, dataset.context_size, 'negative_sampling'))
+        optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+        start_time = time.time()
+        for epoch in range(epochs):
+            permutation = np.random.permutation(len(dataset))
+            for start in range(0, len(dataset), batch_size):
+                contexts, targets = dataset.get_batch(permutation[start:start + batch_size])
+                optimizer.zero_grad()
+                loss = model.loss(tensor_to_cuda(torch.from_numpy(contexts)), tensor_to_cuda(torch.from_numpy(targets)))
+                loss.backward()
+                optimizer.step()
+        seconds = time.time() - start_time
+        print('{}: {:.0f} contexts/sec, final batch loss {:.3f}'.format(model_type, epochs * len(dataset) / seconds, loss.item()))
+        results[model_type] = {'contexts_per_second': epochs * len(dataset) / seconds, 'suites': evaluate_model(model, dataset.unique_vocab), 'model': model}
+
+    frequent_words = [dataset.unique_vocab[i] for i in np.argsort(-dataset.word_counts())[:probe_words]]
+    for word in frequent_words:
+        for model_type, result in results.items():
+            closest = get_closest_word(result['model'], word, dataset.word_to_idx, dataset.unique_vocab)
+            print('{:8s} {:12s} {}'.format(model_type, word, closest))
+    return results
+
+def hogwild_worker(rank, model, tokens, context_size, shard, current_epoch, end_epoch, batch_size, learning_rate, results):
+    '''
+    Worker process of MODEL_EXECUTOR.train_hogwild. Trains the shared model on the
+    windows shard[0] to shard[1] and reports (epoch, loss sum, samples, seconds)
+    for every epoch to the results queue
+    '''
+    # one thread per worker, the parallelism comes from the processes
+    torch.set_num_threads(1)
+    np.random.seed(rank)
+    dataset = CONTEXT_DATASET(tokens.numpy(), [], context_size)
+    optimizer = torch.optim.SGD(model.parameters(), lr=learning_rate)
+    samples = np.arange(shard[0], shard[1])
+    for epoch in range(current_epoch, end_epoch):
+        total_loss = 0.0
+        epoch_start = time.time()
+        permutation = samples[np.random.permutation(len(samples))]
+        for start in range(0, len(permutation), batch_size):
+            batch = permutation[start:start + batch_size]
+            contexts, targets = dataset.get_batch(batch)
+            optimizer.zero_grad()
+            loss = model.loss(torch.from_numpy(contexts), torch.from_numpy(targets))
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(batch)
+        results.put((epoch, total_loss, len(samples), time.time() - epoch_start))
+
+def wait_for_report(results, processes, poll_seconds=HOGWILD_POLL_SECONDS):
+    '''
+    Returns the next epoch report of the hogwild workers. Raises a RuntimeError
+    if a worker failed or all workers exited before sending it
+    '''
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            failed = [(rank, process.exitcode) for rank, process in enumerate(processes) if process.exitcode not in (None, 0)]
+            if failed:
+                raise RuntimeError('hogwild worker {} exited with code {}'.format(*failed[0]))
+            if not any(process.is_alive() for process in processes):
+                raise RuntimeError('all hogwild workers exited before reporting every epoch')
+
+def benchmark_hogwild(model, dataset, process_counts=(1, 2, 4), batch_size=BATCH_SIZE, learning_rate=0.001):
+    '''
+    Train one epoch with every number of processes in process_counts, each time
+    starting from a copy of model, and print the contexts/sec to show the scaling
+    '''
+    throughput = []
+    for num_processes in process_counts:
+        executor = MODEL_EXECUTOR(copy.deepcopy(model))
+        optimizer = torch.optim.SGD(executor.model.parameters(), lr=learning_rate)
+        executor.train_hogwild(optimizer, dataset, EPOCH - 1, None, num_processes, batch_size)
+        throughput.append(executor.contexts_per_second[-1])
+    print('processes  contexts/sec  speedup')
+    for num_processes, contexts_per_second in zip(process_counts, throughput):
+        print('{:9d}  {:12.0f}  {:7.2f}'.format(num_processes, contexts_per_second, contexts_per_second / throughput[0]))
+    return throughput
+
+class CONTEXT_DATASET():
+    '''
+    Context windows over a corpus that is encoded once into an int32 token array.
+    Windows are a strided view on the token array, so no per-window lists are
+    created and the array can be memory mapped from disk.
+    '''
+    def __init__(self, tokens, unique_vocab, context_size=CONTEXT_SIZE):
+        self.tokens = tokens
+        self.unique_vocab = list(unique_vocab)
+        self.word_to_idx = {w: i for i, w in enumerate(self.unique_vocab)}
+        self.context_size = context_size
+        self.counts = None
+        # row i is the window [i, i + 2*context_size], its center word is token i + context_size
+        self.windows = np.lib.stride_tricks.sliding_window_view(tokens, 2 * context_size + 1)
+        self.context_columns = np.r_[0:context_size, context_size + 1:2 * context_size + 1]
+
+    @classmethod
+    def from_corpus(cls, corpus, context_size=CONTEXT_SIZE):
+        '''
+        Encode a list (or any iterable) of words, indices are assigned in order of first occurrence
+        '''
+        word_to_idx = {}
+        tokens = np.fromiter((word_to_idx.setdefault(w, len(word_to_idx)) for w in corpus), dtype=np.int32)
+        return cls(tokens, list(word_to_idx), context_size)
+
+    @classmethod
+    def load(cls, file_prefix, context_size=CONTEXT_SIZE, mmap=True):
+        '''
+        Load an encoded corpus written by save. With mmap the token array is
+        memory mapped read-only, so several trainer processes share one copy
+        '''
+        tokens = np.load(file_prefix + '_tokens.npy', mmap_mode='r' if mmap else None)
+        unique_vocab = np.load(file_prefix + '_vocab.npy').tolist()
+        dataset = cls(tokens, unique_vocab, context_size)
+        if os.path.exists(file_prefix + '_counts.npy'):
+            dataset.counts = np.load(file_prefix + '_counts.npy')
+        return dataset
+
+    def save(self, file_prefix):
+        '''
+        Persist the token array, the vocabulary and the word counts as .npy files.
+        The context size is not stored, the same files serve any window size
+        '''
+        np.save(file_prefix + '_tokens.npy', self.tokens)
+        np.save(file_prefix + '_vocab.npy', np.array(self.unique_vocab))
+        np.save(file_prefix + '_counts.npy', self.word_counts())
+
+    def __len__(self):
+        return len(self.windows)
+
+    def extend_vocabulary(self, unique_vocab):
+        '''
+        Re-encode the tokens for an existing vocabulary, words which are not in it are
+        appended in order of first occurrence. Returns a new CONTEXT_DATASET whose
+        vocabulary starts with unique_vocab
+        '''
+        word_to_idx = {w: i for i, w in enumerate(unique_vocab)}
+        mapping = np.array([word_to_idx.setdefault(w, len(word_to_idx)) for w in self.unique_vocab], dtype=np.int32)
+        return CONTEXT_DATASET(mapping[self.tokens], list(word_to_idx), self.context_size)
+
+    def split_validation(self, fraction=VALIDATION_FRACTION, seed=0):
+        '''
+        Returns the window indices for training and the held out validation indices.
+        The split is fixed by the seed, so a resumed training validates on the same windows
+        '''
+        num_validation = int(len(self) * fraction)
+        permutation = np.random.RandomState(seed).permutation(len(self))
+        return np.sort(permutation[num_validation:]), np.sort(permutation[:num_validation])
+
+    def word_counts(self):
+        '''
+        Returns the number of occurrences of every word, indexed like unique_vocab.
+        The counts are computed once, the token array is not changed after encoding
+        '''
+        if self.counts is None:
+            self.counts = np.bincount(self.tokens, minlength=len(self.unique_vocab))
+        return self.counts
+
+    def keep_probabilities(self, threshold=SUBSAMPLE_THRESHOLD):
+        '''
+        Probability to keep a window for each center word as in word2vec,
+        (sqrt(f / threshold) + 1) * threshold / f for a word with corpus frequency f
+        '''
+        counts = self.word_counts()
+        frequencies = counts / float(max(counts.sum(), 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probabilities = (np.sqrt(frequencies / threshold) + 1) * threshold / frequencies
+        probabilities[counts == 0] = 1.0
+        return np.minimum(probabilities, 1.0)
+
+    def subsample(self, threshold=SUBSAMPLE_THRESHOLD):
+        '''
+        Draw the indices of the windows used in one epoch, a window is kept with
+        the keep probability of its center word
+        '''
+        centers = self.windows[:, self.context_size]
+        keep = np.random.random_sample(len(centers)) < self.keep_probabilities(threshold)[centers]
+        return np.flatnonzero(keep)
+
+    def word_frequencies(self):
+        '''
+        Returns a FreqDist of the encoded corpus
+        '''
+        return FreqDist(dict(zip(self.unique_vocab, self.word_counts().tolist())))
+
+    def get_batch(self, indices):
+        '''
+        Returns the int64 context array of shape (len(indices), 2*context_size)
+        and the int64 center words for the given window indices
+        '''
+        windows = self.windows[indices]
+        contexts = windows[:, self.context_columns].astype(np.int64)
+        targets = windows[:, self.context_size].astype(np.int64)
+        return contexts, targets
+
+def corpus_cache_prefix(corpus_file=CORPUS_FILE, cache_dir=PREPROCESSING_CACHE_DIR):
+    '''
+    File prefix of the cached preprocessing results of corpus_file. The name contains
+    a hash of the corpus content and of every switch that changes the cleaned tokens,
+    so an edited corpus or other cleanup settings never load a stale cache entry
+    '''
+    digest = hashlib.sha256()
+    with open(corpus_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    # the number of workers does not change the tokens, so it is not part of the name
+    settings = {'version': PREPROCESSING_CACHE_VERSION,
+                'remove_rare_words': REMOVE_RARE_WORDS, 'min_word_count': MIN_WORD_COUNT}
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf8'))
+    return os.path.join(cache_dir, '{}-{}'.format(ENCODED_CORPUS_PREFIX, digest.hexdigest()[:16]))
+
+def save_preprocessed_corpus(dataset, file_prefix):
+    '''
+    Store the encoded corpus, its word counts and corpus_attributes under file_prefix.
+    The attributes file is written last, it marks the cache entry as complete
+    '''
+    os.makedirs(os.path.dirname(file_prefix) or '.', exist_ok=True)
+    dataset.save(file_prefix)
+    with open(file_prefix + '_attributes.json.tmp', 'w') as file:
+        json.dump(corpus_attributes, file)
+    os.replace(file_prefix + '_attributes.json.tmp', file_prefix + '_attributes.json')
+
+def load_preprocessed_corpus(file_prefix):
+    '''
+    Returns the CONTEXT_DATASET cached under file_prefix and restores corpus_attributes,
+    None if there is no complete cache entry
+    '''
+    if not os.path.exists(file_prefix + '_attributes.json'):
+        return None
+    with open(file_prefix + '_attributes.json') as file:
+        corpus_attributes.update(json.load(file))
+    return CONTEXT_DATASET.load(file_prefix)
+
+def load_corpus(corpus_file=CORPUS_FILE):
+    '''
+    Returns the cleaned and encoded corpus as CONTEXT_DATASET, from the preprocessing
+    cache if possible. A cache hit skips reading the word lists and the whole cleanup
+    '''
+    cache_prefix = corpus_cache_prefix(corpus_file) if USE_PREPROCESSING_CACHE else None
+    dataset = load_preprocessed_corpus(cache_prefix) if cache_prefix else None
+    if dataset is not None:
+        print('loading preprocessed corpus from {}...\n'.format(cache_prefix))
+    else:
+        preprocessor = DATA_PREPROCESSOR(corpus_file)
+        # tokens are encoded as they are produced, the cleaned corpus is never held as a list
+        dataset = CONTEXT_DATASET(*preprocessor.preprocess_data())
+        if cache_prefix:
+            save_preprocessed_corpus(dataset, cache_prefix)
+    # a cache hit restored corpus_attributes, the plots are the same as after preprocessing
+    plot(dataset.word_frequencies())
+    return dataset
+
+def align_to_checkpoint(dataset, checkpoint_file):
+    '''
+    Encode the dataset with the vocabulary stored in the checkpoint, which may have grown
+    in train_incremental, so the model is built with the size of the checkpoint.
+    Returns the dataset, the word counts of all corpora the checkpoint was trained on and
+    the part of them from other corpora (None if there is none), the base_word_counts of MODEL_EXECUTOR
+    '''
+    if not os.path.exists(checkpoint_file):
+        return dataset, dataset.word_counts(), None
+    checkpoint = load_checkpoint(checkpoint_file)
+    if 'vocab' not in checkpoint:
+        # older checkpoints only fit a corpus with the same vocabulary size
+        vocab_size = checkpoint['state_dict']['embeddings.weight'].shape[0]
+        if vocab_size != len(dataset.unique_vocab):
+            raise ValueError('{} has {} words but the corpus {}, delete or rename the checkpoint'.format(
+                checkpoint_file, vocab_size, len(dataset.unique_vocab)))
+        return dataset, dataset.word_counts(), None
+    checkpoint_vocab = checkpoint['vocab']
+    aligned = dataset.extend_vocabulary(checkpoint_vocab)
+    if len(aligned.unique_vocab) > len(checkpoint_vocab):
+        raise ValueError('{} words of the corpus are not in the vocabulary of {}, delete or rename the checkpoint '
+                         'or train the new text with INCREMENTAL_CORPUS_FILE'.format(len(aligned.unique_vocab) - len(checkpoint_vocab), checkpoint_file))
+    corpus_counts = aligned.word_counts().astype(np.int64)
+    if 'word_counts' not in checkpoint:
+        return aligned, corpus_counts, None
+    word_counts = checkpoint['word_counts'].numpy()
+    return aligned, word_counts, np.maximum(word_counts - corpus_counts, 0)
+
+def train_incremental(checkpoint_file, corpus_file, epochs=INCREMENTAL_EPOCHS):
+    '''
+    Continue training a checkpoint on new text only. The vocabulary stored in the
+    checkpoint is extended with the new words, the model and the optimizer state grow
+    to the new vocabulary and epochs are trained on the windows of the new text.
+    Returns the executor, the model and the dataset of the new text
+    '''
+    checkpoint = load_checkpoint(checkpoint_file)
+    if 'vocab' not in checkpoint:
+        raise ValueError('{} has no vocabulary, it can not be extended'.format(checkpoint_file))
+    base_vocab = checkpoint['vocab']
+    # older checkpoints have no word counts, all known words are then weighted equally
+    base_counts = checkpoint['word_counts'].numpy() if 'word_counts' in checkpoint else np.ones(len(base_vocab), dtype=np.int64)
+    dataset = load_corpus(corpus_file).extend_vocabulary(base_vocab)
+    word_counts = dataset.word_counts().astype(np.int64)
+    word_counts[:len(base_vocab)] += base_counts
+    print('{} new words added to the vocabulary of {} words\n'.format(len(dataset.unique_vocab) - len(base_vocab), len(base_vocab)))
+
+    # the checkpoint is restored into a model of its own size and grown afterwards
+    model = build_model(MODEL_TYPE, len(base_vocab), word_counts[:len(base_vocab)], dataset.context_size, sparse=SPARSE_GRADIENTS)
+    optimizer = build_optimizer(model)
+    model.load_state_dict(checkpoint['state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    model.grow_vocabulary(len(dataset.unique_vocab), word_counts, optimizer)
+
+    executor = MODEL_EXECUTOR(model, base_word_counts=base_counts)
+    current_epoch = checkpoint['epoch']
+    subsample_threshold = SUBSAMPLE_THRESHOLD if SUBSAMPLE_FREQUENT_WORDS else None
+    # the new rows start from random weights, so the learning rate schedule starts over for the new text
+    cbow = executor.train_batched(optimizer, dataset, current_epoch, checkpoint_file, subsample_threshold=subsample_threshold,
+                                  end_epoch=current_epoch + epochs, lr_schedule_start=current_epoch)
+    return executor, cbow, dataset
+
+def print_closest_word(cbow, word, word_to_idx,unique_vocab, index=None):
+    if index is not None:
+        closest_word = index.most_similar(word)
+    else:
+        closest_word = get_closest_word(cbow, word, word_to_idx, unique_vocab)
     print("Closest words to %s are %s" % (word, closest_word))
 
 
-def get_closest_word(cbow, word, word_to_idx,unique_vocab):
+class SIMILARITY_ENGINE():
+    '''
+    Cosine similarity search over the embedding matrix of a model.
+    The row normalised embedding matrix is computed once and cached until the weights change
+    '''
+    def __init__(self, model, word_to_idx, unique_vocab):
+        self.model = model
+        self.word_to_idx = word_to_idx
+        self.unique_vocab = unique_vocab
+        self.weights_version = None
+        self.normalized = None
+
+    def normalized_embeddings(self):
+        '''
+        Returns the embedding matrix with unit length rows as numpy array
+        '''
+        weight = self.model.embeddings.weight
+        # optimizer steps and load_state_dict update the weights in-place, which bumps the tensor version
+        version = (weight.data_ptr(), weight._version)
+        if version != self.weights_version:
+            matrix = weight.detach().cpu().numpy().astype(np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self.normalized = matrix / np.maximum(norms, 1e-6)
+            self.weights_version = version
+        return self.normalized
+
+    def most_similar(self, words, topn=5):
+        '''
+        Returns the topn (word, cosine similarity) pairs closest to word, most similar first.
+        words can also be a list of words, then a list of results is returned.
+        All queries are answered with one matrix product
+        '''
+        single_query = isinstance(words, str)
+        if single_query:
+            words = [words]
+        matrix = self.normalized_embeddings()
+        query = np.array([self.word_to_idx[word] for word in words])
+        scores = matrix[query] @ matrix.T
+        # never return the query word itself
+        scores[np.arange(len(query)), query] = -np.inf
+        topn = min(topn, len(self.unique_vocab) - 1)
+        top = np.argpartition(-scores, topn - 1, axis=1)[:, :topn]
+        results = []
+        for row, candidates in zip(scores, top):
+            candidates = candidates[np.argsort(-row[candidates])]
+            results.append([(self.unique_vocab[j], float(row[j])) for j in candidates])
+        return results[0] if single_query else results
+
+def get_similarity_engine(cbow, word_to_idx, unique_vocab):
+    '''
+    Returns the SIMILARITY_ENGINE of a model, it is created on first use and kept with the model
+    '''
+    engine = getattr(cbow, 'similarity_engine', None)
+    if engine is None or engine.unique_vocab is not unique_vocab:
+        engine = SIMILARITY_ENGINE(cbow, word_to_idx, unique_vocab)
+        cbow.similarity_engine = engine
+    return engine
+
+def get_closest_word(cbow, word, word_to_idx,unique_vocab, topn=5):
     '''
     Returns 5 closest neighbours( determined by cosine similarity)
     for the input word.
-    Returns a list of 5 closest neighbours and their distansce from the word
-    '''
-    word_distance = []
-    topn=5
-    emb = cbow.embeddings
-    pdist = nn.PairwiseDistance()
-    pdist = nn.CosineSimilarity(dim=1, eps=1e-6)
-    i = word_to_idx[word]
-    # use cuda support if available and send the tensors to the correct device
-    lookup_tensor_i = tensor_to_cuda(torch.tensor([i], dtype=torch.long))
-
-    v_i = emb(lookup_tensor_i).view(1, -1)
-    index_to_word = {idx: w for (idx, w) in enumerate(unique_vocab)}
-    for j in range(len(unique_vocab)):
-        if j != i:
-            # use cuda support if available and send the tensors to the correct device
-            lookup_tensor_j = tensor_to_cuda(torch.tensor([j], dtype=torch.long))
-            v_j = emb(lookup_tensor_j)
-            word_distance.append((index_to_word[j], float(abs(pdist(v_i, v_j)))))
-    word_distance.sort(key=lambda x: x[1])
-    return word_distance[:topn]
-
-
-def show_closest_words(cbow, word_to_idx, unique_vocab):
+    Returns a list of 5 closest neighbours and their cosine similarity to the word
+    '''
+    return get_similarity_engine(cbow, word_to_idx, unique_vocab).most_similar(word, topn)
+
+def build_ann_index(cbow, unique_vocab, index_file=ANN_INDEX_FILE):
+    '''
+    Build an approximate nearest neighbour index over the trained embeddings,
+    save it and print its recall against the exact search.
+    The index is a snapshot, it has to be rebuilt after further training
+    '''
+    weights = cbow.embeddings.weight.detach().cpu().numpy()
+    index = IVF_INDEX().build(weights, unique_vocab)
+    index.save(index_file)
+    benchmark_index(index)
+    return index
+
+
+def build_quantized_index(cbow, word_to_idx, unique_vocab, mode=QUANTIZATION):
+    '''
+    Quantise the trained embeddings ('int8' scalar or 'pq' product quantisation),
+    save the index next to the exported embeddings and compare it with get_closest_word
+    '''
+    weights = cbow.embeddings.weight.detach().cpu().numpy()
+    index = INT8_INDEX() if mode == 'int8' else PQ_INDEX()
+    index.build(weights, unique_vocab)
+    index.save('{}-{}.npz'.format(os.path.splitext(EMBEDDINGS_FILE)[0], mode))
+    benchmark_quantization(index, weights, lambda word, topn: get_closest_word(cbow, word, word_to_idx, unique_vocab, topn))
+    return index
+
+def evaluate_model(cbow, unique_vocab, similarity_file=SIMILARITY_FILE, analogy_file=ANALOGY_FILE):
+    '''
+    Run the word similarity and analogy suites whose files exist (see evaluate_embeddings)
+    '''
+    similarity_file = similarity_file if os.path.exists(similarity_file) else None
+    analogy_file = analogy_file if os.path.exists(analogy_file) else None
+    if similarity_file is None and analogy_file is None:
+        return {}
+    evaluator = EVALUATOR(cbow.embeddings.weight.detach().cpu().numpy(), unique_vocab)
+    return evaluator.run(similarity_file, analogy_file)
+
+def show_closest_words(cbow, word_to_idx, unique_vocab, index=None):
     # Todo get run frequency calc on whole corpus and get one rare, one normal and one frequent each
     print('\n verbs:\n')
-    print_closest_word(cbow, 'come',word_to_idx,unique_vocab)
-    print_closest_word(cbow, 'see',word_to_idx,unique_vocab)
-    print_closest_word(cbow, 'take',word_to_idx,unique_vocab)
+    print_closest_word(cbow, 'come',word_to_idx,unique_vocab,index)
+    print_closest_word(cbow, 'see',word_to_idx,unique_vocab,index)
+    print_closest_word(cbow, 'take',word_to_idx,unique_vocab,index)
     
     print('\n noun:\n')
-    print_closest_word(cbow, 'king',word_to_idx,unique_vocab)
-    print_closest_word(cbow, 'father',word_to_idx,unique_vocab)
-    print_closest_word(cbow, 'lady',word_to_idx,unique_vocab)
+    print_closest_word(cbow, 'king',word_to_idx,unique_vocab,index)
+    print_closest_word(cbow, 'father',word_to_idx,unique_vocab,index)
+    print_closest_word(cbow, 'lady',word_to_idx,unique_vocab,index)
     
     print('\n adjectives:\n')
-    print_closest_word(cbow, 'noble',word_to_idx,unique_vocab)
-    print_closest_word(cbow, 'great',word_to_idx,unique_vocab)
-    print_closest_word(cbow, 'fair',word_to_idx,unique_vocab)
+    print_closest_word(cbow, 'noble',word_to_idx,unique_vocab,index)
+    print_closest_word(cbow, 'great',word_to_idx,unique_vocab,index)
+    print_closest_word(cbow, 'fair',word_to_idx,unique_vocab,index)
     
 def display_word_similarity(model):
     word_1 = 'king'
@@ -424,26 +1804,59 @@ def display_word_similarity(model):
     word_similarity = (((word_1_vec.squeeze()).dot(word_2_vec.squeeze())) / (torch.norm(word_1_vec) * torch.norm(word_2_vec))).data.item()
     print("Similarity between '{}' & '{}' : {:0.4f}".format(word_1, word_2, word_similarity))
 
+def report_model(executor, cbow, word_to_idx, unique_vocab):
+    '''
+    Evaluate, export and query the trained model
+    '''
+    # get two words similarity
+    executor.test(unique_vocab,word_to_idx)
+    evaluate_model(cbow, unique_vocab)
+
+    if EXPORT_EMBEDDINGS:
+        cbow.export_embeddings(EMBEDDINGS_FILE, unique_vocab)
+
+    if QUANTIZATION is not None:
+        build_quantized_index(cbow, word_to_idx, unique_vocab)
+
+    index = None
+    if USE_ANN_INDEX:
+        index = build_ann_index(cbow, unique_vocab)
+    show_closest_words(cbow, word_to_idx,unique_vocab,index)
+
 def main():
     """
     main function
     In order to run CBOW 2 or 5 change CONTEXT_SIZE to 2 or 5 respectively
     """
-    preprocessor = DATA_PREPROCESSOR('shakespeare-corpus.txt')
-    corpus = preprocessor.preprocess_data()
-    plot(corpus)
-    data, unique_vocab, word_to_idx = create_context(corpus)
+    if RUN_BENCHMARKS:
+        benchmark_token_classifier()
+
+    checkpoint_file ='checkpoint.pth'
+    if INCREMENTAL_CORPUS_FILE is not None and os.path.exists(checkpoint_file):
+        # only the new text is preprocessed and trained
+        start_time = time.time()
+        executor, cbow, dataset = train_incremental(checkpoint_file, INCREMENTAL_CORPUS_FILE)
+        print("--- %s seconds ---" % (time.time() - start_time))
+        report_model(executor, cbow, dataset.word_to_idx, dataset.unique_vocab)
+        return
+
+    # an existing checkpoint defines the vocabulary, it may contain words of incrementally trained text
+    dataset, word_counts, base_word_counts = align_to_checkpoint(load_corpus(CORPUS_FILE), checkpoint_file)
+    unique_vocab, word_to_idx = dataset.unique_vocab, dataset.word_to_idx
+    if not BATCH_TRAINING:
+        # the per-sample trainer works on the words themselves
+        corpus = [dataset.unique_vocab[token] for token in dataset.tokens]
+        data, _, _ = create_context(corpus)
 
     #train model- changed global variable if needed
-    model=CBOW(len(unique_vocab), EMBEDDING_DIM, CONTEXT_SIZE)
-    if USE_ADAM:
-        print('Using adam as optimizer')
-        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
-    else:
-        print('Using SGD as optimizer')
-        optimizer = torch.optim.SGD(model.parameters(), lr=0.001)
+    # hogwild workers apply sparse updates to the shared embedding tables
+    model = build_model(MODEL_TYPE, len(unique_vocab), word_counts, sparse=SPARSE_GRADIENTS or NUM_TRAINING_PROCESSES > 1)
+    optimizer = build_optimizer(model)
+    if RUN_BENCHMARKS and BATCH_TRAINING:
+        benchmark_sparse_gradients(dataset, word_counts)
+        benchmark_hogwild(model, dataset)
+        compare_models(dataset, word_counts)
 
-    checkpoint_file ='checkpoint.pth'
     checkpoint_available= os.path.exists(checkpoint_file)
     if checkpoint_available:
       model, optimizer, current_epoch = reset_model_to_checkpoint(model, optimizer, checkpoint_file)
@@ -451,18 +1864,21 @@ def main():
       print('no checkpoint found. initializing new model..\n')
       current_epoch=0  
 
-    executor = MODEL_EXECUTOR(model)
+    executor = MODEL_EXECUTOR(model, base_word_counts=base_word_counts)
     if RESUME_TRAINING or not checkpoint_available:
       print('resuming training...\n')
-      import time
       start_time = time.time()
-      cbow = executor.train(optimizer, data, unique_vocab, word_to_idx, current_epoch, checkpoint_file)
+      if BATCH_TRAINING and NUM_TRAINING_PROCESSES > 1:
+        cbow = executor.train_hogwild(optimizer, dataset, current_epoch, checkpoint_file)
+      elif BATCH_TRAINING:
+        subsample_threshold = SUBSAMPLE_THRESHOLD if SUBSAMPLE_FREQUENT_WORDS else None
+        cbow = executor.train_batched(optimizer, dataset, current_epoch, checkpoint_file, subsample_threshold=subsample_threshold)
+      else:
+        cbow = executor.train(optimizer, data, unique_vocab, word_to_idx, current_epoch, checkpoint_file, dataset)
       print("--- %s seconds ---" % (time.time() - start_time))
     else:
       print('pre-trained model loaded. no further training...\n')
+      cbow = model
+    report_model(executor, cbow, word_to_idx, unique_vocab)
 
-    # get two words similarity
-    executor.test(unique_vocab,word_to_idx)
-
-    show_closest_words(cbow, word_to_idx,unique_vocab)
 if __name__ == "__main__": main()
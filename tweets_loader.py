@@ -0,0 +1,382 @@
+"""
+Shared loader for the tweets.json corpus of the language identification exercises.
+
+tweets.json has one JSON object per line, only the tweetIDs and text fields are kept.
+The file is read in line aligned chunks of CHUNK_SIZE bytes. Every chunk is parsed with
+one json.loads call and reduced to an int64 id array and a list of texts right away,
+so the other fields and the per tweet dicts never pile up in memory. With
+num_workers > 1 the chunks are parsed in a process pool.
+
+cached_frames stores the data frames built from the source files (the merged train
+and test sets) in a columnar format, Parquet if pyarrow or fastparquet is installed
+and otherwise NumPy .npz files. The cache is reused until a source file changes.
+
+TWEET_INDEX joins label files with the tweets on tweetIDs. The ids are hashed once
+(sorted, if they are not unique) and every label file is resolved against that index,
+instead of one pd.merge per label file which hashes the whole tweets frame again.
+
+Benchmark against the line by line loader:
+    python tweets_loader.py tweets.json --workers 1 2 4
+    python tweets_loader.py tweets.json --synthetic 3000000
+    python tweets_loader.py tweets.json --labels labels-train+dev.tsv labels-test.tsv
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 16 * 2**20 # bytes of the file parsed at once
+NUM_WORKERS = 1 # processes parsing chunks, 1 parses in the calling process
+CACHE_DIR = 'tweets-cache' # directory of the cached data frames
+CACHE_VERSION = 1 # increase when the cached frames are built differently, old entries are then rebuilt
+
+
+def chunk_offsets(file_name, chunk_size=CHUNK_SIZE):
+    '''
+    Split the file into ranges of whole lines of about chunk_size bytes.
+    Returns the (start, end) byte offsets of the ranges in file order
+    '''
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    with open(file_name, 'rb') as file:
+        while offsets[-1] < size:
+            file.seek(min(offsets[-1] + chunk_size, size))
+            # move on to the start of the next line
+            file.readline()
+            offsets.append(min(file.tell(), size))
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def parse_chunk(chunk):
+    '''
+    Parse the lines in the byte range (file_name, start, end).
+    Returns the tweet ids as int64 array and the texts as list
+    '''
+    file_name, start, end = chunk
+    with open(file_name, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    # utf-8-sig drops the byte order mark at the start of the file
+    lines = [line for line in data.decode('utf-8-sig' if start == 0 else 'utf-8').split('\n') if line.strip()]
+    tweets = json.loads('[' + ','.join(lines) + ']')
+    ids = np.fromiter((int(tweet['tweetIDs']) for tweet in tweets), dtype=np.int64, count=len(tweets))
+    texts = [tweet.get('text') for tweet in tweets]
+    return ids, texts
+
+
+def load_tweets(file_name, num_workers=NUM_WORKERS, chunk_size=CHUNK_SIZE):
+    '''
+    Returns a DataFrame with the int64 column tweetIDs and the column text,
+    rows are in file order for any number of workers
+    '''
+    chunks = [(file_name, start, end) for start, end in chunk_offsets(file_name, chunk_size)]
+    ids, texts = [], []
+    if num_workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            for chunk_ids, chunk_texts in pool.imap(parse_chunk, chunks):
+                ids.append(chunk_ids)
+                texts.extend(chunk_texts)
+    else:
+        for chunk in chunks:
+            chunk_ids, chunk_texts = parse_chunk(chunk)
+            ids.append(chunk_ids)
+            texts.extend(chunk_texts)
+    tweet_ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    return pd.DataFrame({'tweetIDs': tweet_ids, 'text': texts})
+
+
+def load_tweets_per_line(file_name):
+    '''
+    The previous loader of the exercises, kept as benchmark reference:
+    every line becomes a dict, the DataFrame is built from the list of dicts
+    '''
+    tweets = []
+    for line in open(file_name, 'r',encoding='utf-8-sig'):
+        tweets.append(json.loads(line))
+    tweets_df = pd.DataFrame(tweets, columns=['tweetIDs','text'])
+    tweets_df['tweetIDs']=tweets_df['tweetIDs'].astype('int64')
+    return tweets_df
+
+
+class TWEET_INDEX():
+    '''
+    tweetID -> row index over a tweets frame, built once and used to join any number
+    of label frames. Unique ids are looked up in a hash index, duplicate ids with
+    binary searches in the sorted ids
+    '''
+    def __init__(self, tweets):
+        self.tweets = tweets
+        ids = tweets['tweetIDs'].to_numpy(dtype=np.int64)
+        self.index = pd.Index(ids)
+        self.unique_ids = self.index.is_unique
+        if not self.unique_ids:
+            self.order = np.argsort(ids, kind='stable')
+            self.sorted_ids = ids[self.order]
+
+    def match(self, label_ids):
+        '''
+        Returns the tweet rows and label rows of all matching pairs, ordered like the
+        tweets and the pairs of one tweet like the labels
+        '''
+        if self.unique_ids:
+            positions = self.index.get_indexer(label_ids)
+            found = np.flatnonzero(positions >= 0)
+            # scatter the labels to their tweets, this orders them without sorting
+            label_of_tweet = np.full(len(self.tweets), -1, dtype=np.int64)
+            label_of_tweet[positions[found]] = found
+            tweet_rows = np.flatnonzero(label_of_tweet >= 0)
+            if len(tweet_rows) == len(found):
+                return tweet_rows, label_of_tweet[tweet_rows]
+            # some tweets have several labels
+            tweet_rows, label_rows = positions[found], found
+        else:
+            # searching the ids in sorted order keeps the binary searches cache friendly
+            query_order = np.argsort(label_ids, kind='stable')
+            first = np.empty(len(label_ids), dtype=np.int64)
+            last = np.empty(len(label_ids), dtype=np.int64)
+            first[query_order] = np.searchsorted(self.sorted_ids, label_ids[query_order], side='left')
+            last[query_order] = np.searchsorted(self.sorted_ids, label_ids[query_order], side='right')
+            matches = last - first
+            # one pair per matching (tweet, label)
+            label_rows = np.repeat(np.arange(len(label_ids)), matches)
+            match_offsets = np.arange(len(label_rows)) - np.repeat(np.cumsum(matches) - matches, matches)
+            tweet_rows = self.order[np.repeat(first, matches) + match_offsets]
+        pairs = np.argsort(tweet_rows, kind='stable')
+        return tweet_rows[pairs], label_rows[pairs]
+
+    def join(self, labels):
+        '''
+        Inner join of labels with the tweets on tweetIDs. Gives the rows, order and
+        columns of pd.merge(tweets, labels, on='tweetIDs', how='inner') when every id is
+        unique in both frames. With duplicate ids the rows are the same, ordered like the
+        tweets and the matches of one tweet like the labels
+        '''
+        columns = [name for name in labels.columns if name != 'tweetIDs']
+        if set(columns) & set(self.tweets.columns):
+            raise ValueError('label columns {} are also tweet columns'.format(sorted(set(columns) & set(self.tweets.columns))))
+        tweet_rows, label_rows = self.match(labels['tweetIDs'].to_numpy(dtype=np.int64))
+        merged = self.tweets.take(tweet_rows).reset_index(drop=True)
+        for name in columns:
+            merged[name] = labels[name].take(label_rows).reset_index(drop=True)
+        return merged
+
+
+def file_digest(file_name):
+    '''
+    SHA-256 of the file content
+    '''
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parquet_available():
+    for engine in ['pyarrow', 'fastparquet']:
+        try:
+            __import__(engine)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+def write_frame(frame, file_prefix):
+    '''
+    Write a data frame as Parquet or, without a Parquet engine, as .npz file.
+    In the .npz file numeric columns are stored as they are and text columns as one
+    utf-8 buffer with the character offsets of the values. Lone surrogates, which
+    json.loads keeps from truncated escapes like "\\ud83d", are stored with surrogatepass.
+    The index is not stored
+    '''
+    if parquet_available():
+        frame.to_parquet(file_prefix + '.parquet', index=False)
+        return
+    arrays = {'columns': np.array([str(name) for name in frame.columns])}
+    for i, name in enumerate(frame.columns):
+        values = frame[name]
+        if values.dtype.kind in 'biuf':
+            arrays['values_{}'.format(i)] = values.to_numpy()
+            continue
+        missing = values.isna().to_numpy()
+        strings = [str(value) for value in values.where(~missing, '')]
+        lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+        arrays['text_{}'.format(i)] = np.frombuffer(''.join(strings).encode('utf-8', 'surrogatepass'), dtype=np.uint8)
+        arrays['offsets_{}'.format(i)] = np.concatenate([[0], np.cumsum(lengths)])
+        arrays['missing_{}'.format(i)] = missing
+    np.savez(file_prefix + '.npz', **arrays)
+
+
+def read_frame(file_prefix):
+    '''
+    Read a data frame written by write_frame
+    '''
+    if os.path.exists(file_prefix + '.parquet'):
+        return pd.read_parquet(file_prefix + '.parquet')
+    arrays = np.load(file_prefix + '.npz')
+    columns = {}
+    for i, name in enumerate(arrays['columns'].tolist()):
+        if 'values_{}'.format(i) in arrays:
+            columns[name] = arrays['values_{}'.format(i)]
+            continue
+        text = arrays['text_{}'.format(i)].tobytes().decode('utf-8', 'surrogatepass')
+        offsets = arrays['offsets_{}'.format(i)].tolist()
+        values = pd.Series([text[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+        columns[name] = values.mask(arrays['missing_{}'.format(i)])
+    return pd.DataFrame(columns)
+
+
+def source_state(file_name):
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def write_manifest(manifest_file, manifest):
+    with open(manifest_file + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def cached_frames(source_files, build, cache_dir=CACHE_DIR):
+    '''
+    Returns the tuple of data frames build() creates from source_files, from the cache
+    if no source file changed. Files with the size and mtime of the cache manifest are
+    unchanged, otherwise their content hash decides, so touching a file keeps the cache
+    '''
+    key = json.dumps([CACHE_VERSION] + [os.path.abspath(file_name) for file_name in source_files])
+    file_prefix = os.path.join(cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+    manifest_file = file_prefix + '-manifest.json'
+    states = [source_state(file_name) for file_name in source_files]
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+        unchanged, touched = True, False
+        for file_name, state, cached in zip(source_files, states, manifest['sources']):
+            if state['size'] != cached['size']:
+                unchanged = False
+            elif unchanged and state['mtime_ns'] != cached['mtime_ns']:
+                unchanged = file_digest(file_name) == cached['sha256']
+                cached['mtime_ns'], touched = state['mtime_ns'], True
+        if unchanged:
+            start_time = time.perf_counter()
+            frames = tuple(read_frame('{}-{}'.format(file_prefix, i)) for i in range(manifest['frames']))
+            if touched:
+                # remember the new mtimes so the files are not hashed again
+                write_manifest(manifest_file, manifest)
+            print('loaded {} cached data frames in {:.2f} s'.format(len(frames), time.perf_counter() - start_time))
+            return frames
+
+    frames = tuple(build())
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(manifest_file):
+        # the old entry is invalid as soon as its frames are overwritten
+        os.remove(manifest_file)
+    for i, frame in enumerate(frames):
+        write_frame(frame, '{}-{}'.format(file_prefix, i))
+    for file_name, state in zip(source_files, states):
+        state['sha256'] = file_digest(file_name)
+    # the manifest is written last, it marks the cache entry as complete
+    write_manifest(manifest_file, {'sources': states, 'frames': len(frames)})
+    return frames
+
+
+def write_synthetic_tweets(source_file, file_name, num_lines):
+    '''
+    Write num_lines tweets by repeating the tweets of source_file with new unique ids
+    '''
+    with open(source_file, 'r', encoding='utf-8-sig') as file:
+        tweets = [json.loads(line) for line in file if line.strip()]
+    with open(file_name, 'w', encoding='utf-8') as file:
+        for i in range(num_lines):
+            tweet = dict(tweets[i % len(tweets)])
+            tweet['tweetIDs'] = str(10**17 + i)
+            file.write(json.dumps(tweet) + '\n')
+
+
+def benchmark_loaders(file_name, worker_counts=(1, 2, 4)):
+    '''
+    Time the per line loader and the chunked loader with several worker counts,
+    the peak python memory is traced for the loaders running in this process
+    '''
+    # memory of pool workers is not traced
+    loaders = [('per line', lambda: load_tweets_per_line(file_name), True)]
+    for num_workers in worker_counts:
+        loaders.append(('chunked, {} workers'.format(num_workers), lambda n=num_workers: load_tweets(file_name, n), num_workers == 1))
+    results = {}
+    reference = None
+    print('{:22s} {:>10s} {:>14s}'.format('loader', 'seconds', 'peak MB'))
+    for name, loader, traced in loaders:
+        start_time = time.perf_counter()
+        tweets_df = loader()
+        seconds = time.perf_counter() - start_time
+        peak_mb = float('nan')
+        if traced:
+            tracemalloc.start()
+            loader()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        if reference is None:
+            reference = tweets_df
+        elif not reference.equals(tweets_df):
+            raise AssertionError('{} loaded different tweets'.format(name))
+        results[name] = (seconds, peak_mb)
+        print('{:22s} {:10.2f} {:14.1f}'.format(name, seconds, peak_mb))
+    return results
+
+
+def benchmark_joins(tweets, label_frames):
+    '''
+    Time and peak python memory of one pd.merge per label frame against
+    one TWEET_INDEX resolving all label frames
+    '''
+    def merge_each():
+        return [pd.merge(left = tweets, right=labels,left_on ='tweetIDs',right_on='tweetIDs', how='inner') for labels in label_frames]
+
+    def index_join():
+        index = TWEET_INDEX(tweets)
+        return [index.join(labels) for labels in label_frames]
+
+    results = {}
+    print('{:12s} {:>10s} {:>14s}'.format('join', 'seconds', 'peak MB'))
+    for name, join in [('pd.merge', merge_each), ('TWEET_INDEX', index_join)]:
+        start_time = time.perf_counter()
+        merged = join()
+        seconds = time.perf_counter() - start_time
+        tracemalloc.start()
+        join()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        results[name] = (seconds, peak_mb, merged)
+        print('{:12s} {:10.3f} {:14.1f}'.format(name, seconds, peak_mb))
+    for expected, joined in zip(results['pd.merge'][2], results['TWEET_INDEX'][2]):
+        # with duplicate ids only the order of the rows may differ
+        if not expected.equals(joined) and not expected.sort_values(list(expected.columns)).reset_index(drop=True).equals(
+                joined.sort_values(list(joined.columns)).reset_index(drop=True)):
+            raise AssertionError('TWEET_INDEX join differs from pd.merge')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tweets.json loaders')
+    parser.add_argument('tweets', help='tweets.json file')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts of the chunked loader')
+    parser.add_argument('--synthetic', type=int, help='benchmark on a file with this many lines generated from the tweets')
+    parser.add_argument('--labels', nargs='+', help='benchmark the join of these label files with the tweets instead of the loaders')
+    args = parser.parse_args()
+    if args.labels:
+        label_frames = [pd.read_csv(file_name, sep = '\t', header=None,names = ['label','tweetIDs']) for file_name in args.labels]
+        benchmark_joins(load_tweets(args.tweets), label_frames)
+        return
+    file_name = args.tweets
+    if args.synthetic:
+        file_name = 'tweets-synthetic.json'
+        write_synthetic_tweets(args.tweets, file_name, args.synthetic)
+    benchmark_loaders(file_name, args.workers)
+
+if __name__ == "__main__": main()